@@ -0,0 +1,186 @@
+"""benchmark.py
+Micro and macro benchmarks for raycasting, dynamics, control and full episodes.
+
+Fixtures are built from the shipped maps with fixed poses, so runs are
+reproducible. Results are written as JSON and can be compared against a
+stored baseline to catch performance regressions.
+
+`python benchmark.py --save-baseline`      record bench_baseline.json
+`python benchmark.py`                      run and compare against it
+"""
+
+import matplotlib
+matplotlib.use("Agg")
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+
+import numpy as np
+
+from simulator import Map, LidarSimulator, Robot, PositionController
+from dynamics import QuadDynamics, init_state, param_dict
+from controller import go_to_position
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+BEAM_COUNTS = (10, 90, 360, 1440)
+NEAREST_BEAM_COUNTS = (10, 360)
+
+# Fixed lidar poses (x, y, yaw) on every map
+LIDAR_POSES = [(50.3, 10.7, 0.0), (20.5, 40.2, 0.3), (60.1, 70.9, -1.2)]
+
+
+def time_call(func, number, repeat=5):
+    """Time func, returning best and median seconds per call."""
+    func()  # warm up (lazy fields, numba compilation)
+    times = np.array(timeit.repeat(func, number=number, repeat=repeat)) / number
+    return {"best": float(np.min(times)), "median": float(np.median(times)),
+            "number": number, "repeat": repeat}
+
+
+def bench_lidar(maps):
+    results = {}
+    for map_name, map1 in maps.items():
+        for method in LidarSimulator.METHODS:
+            for n_beams in BEAM_COUNTS:
+                lidar = LidarSimulator(map1, angles=np.arange(n_beams) * 360. / n_beams,
+                                       method=method)
+
+                def scan():
+                    for pose in LIDAR_POSES:
+                        lidar.update_reading(pose[:2], pose[2])
+                key = "lidar/" + method + "/" + map_name + "/" + str(n_beams)
+                results[key] = time_call(scan, number=max(1, 2000 // n_beams))
+    return results
+
+
+def bench_dynamics():
+    results = {}
+    u = np.full(4, 408750.)
+    for mode in QuadDynamics.MODES:
+        quad_dyn = QuadDynamics(mode=mode)
+        state = init_state()
+        results["dynamics/" + mode] = time_call(
+            lambda: quad_dyn.step_dynamics(state, u), number=2000)
+    return results
+
+
+def bench_control():
+    state = init_state()
+    des_pos = np.array([3, -3, 9])
+    return {"control/go_to_position": time_call(
+        lambda: go_to_position(state, des_pos, param_dict), number=2000)}
+
+
+def bench_episode(maps, steps=100):
+    results = {}
+    for map_name, map1 in maps.items():
+        def episode():
+            robot = Robot(map1)
+            for i in range(steps):
+                robot.update()
+        results["episode/" + map_name + "/" + str(steps)] = time_call(
+            episode, number=1, repeat=3)
+    return results
+
+
+def bench_nearest(maps, steps=100):
+    """Full episodes per PositionController nearest_method. "beams" traces
+    the lidar every scan, "visibility" and "index" do not need it."""
+    results = {}
+    for map_name, map1 in maps.items():
+        for n_beams in NEAREST_BEAM_COUNTS:
+            for nearest_method in PositionController.NEAREST_METHODS:
+                def episode():
+                    lidar = LidarSimulator(map1, angles=np.arange(n_beams) * 360. / n_beams)
+                    robot = Robot(map1, lidar=lidar,
+                                  pos_cont=PositionController(lidar, nearest_method))
+                    for i in range(steps):
+                        robot.update()
+                key = "nearest/" + nearest_method + "/" + map_name + "/" + str(n_beams)
+                results[key] = time_call(episode, number=1, repeat=3)
+    return results
+
+
+def run_benchmarks(select=None):
+    """Run all benchmarks whose group (lidar, dynamics, control, episode,
+    nearest) is in select (all if None)."""
+    maps = {}
+    for name in sorted(os.listdir(DATA_DIR)):
+        if name.endswith(".dat"):
+            maps[name[:-4]] = Map(os.path.join(DATA_DIR, name))
+
+    groups = {"lidar": lambda: bench_lidar(maps),
+              "dynamics": bench_dynamics,
+              "control": bench_control,
+              "episode": lambda: bench_episode(maps),
+              "nearest": lambda: bench_nearest(maps)}
+    results = {}
+    for group, bench in groups.items():
+        if select is None or group in select:
+            results.update(bench())
+    return {"meta": {"python": platform.python_version(), "numpy": np.__version__,
+                     "machine": platform.machine(), "time": time.strftime("%Y-%m-%d %H:%M:%S")},
+            "results": results}
+
+
+def compare(current, baseline, threshold=0.2):
+    """Print best time of every benchmark against baseline. Returns the names
+    that got slower by more than threshold (fraction)."""
+    regressions = []
+    for name, res in sorted(current["results"].items()):
+        if name not in baseline["results"]:
+            print("%-45s %10.1f us  (new)" % (name, res["best"] * 1e6))
+            continue
+        base = baseline["results"][name]["best"]
+        ratio = res["best"] / base
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print("%-45s %10.1f us  %10.1f us  x%.2f%s" % (
+            name, res["best"] * 1e6, base * 1e6, ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--out", default="bench_results.json", help="where to write results")
+    parser.add_argument("--baseline", default="bench_baseline.json", help="baseline to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="write results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="slowdown fraction reported as regression (default 0.2)")
+    parser.add_argument("--only", nargs="+", choices=["lidar", "dynamics", "control", "episode", "nearest"],
+                        help="run only these benchmark groups")
+    args = parser.parse_args(argv)
+
+    current = run_benchmarks(args.only)
+    with open(args.out, "w") as out_file:
+        json.dump(current, out_file, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as out_file:
+            json.dump(current, out_file, indent=2)
+        print("Saved baseline to " + args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        compare(current, {"results": {}})
+        print("No baseline at " + args.baseline + ", run with --save-baseline")
+        return 0
+
+    with open(args.baseline) as base_file:
+        baseline = json.load(base_file)
+    regressions = compare(current, baseline, args.threshold)
+    if regressions:
+        print(str(len(regressions)) + " regression(s) above " + str(args.threshold * 100) + "%")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -205,3 +205,134 @@ def angerr2u(error, theta, tot_thrust, param_dict):
     r3 = tot_thrust/4 + (e2*Izz)/(4*b) + (e1*Iyy)/(2*k*L)
 
     return np.array([r0, r1, r2, r3])
+
+
+def go_to_position_batch(state, des_pos, param_dict, integral_p_err=None, integral_v_err=None):
+    """Batched go_to_position() for N vehicles. Gives the same motor commands as
+    calling go_to_position() per vehicle.
+
+    Parameters
+    ----------
+    state : dict
+        contains current x, xdot, theta, thetadot, each (N, 3) np.ndarray
+
+    des_pos : (N, 3) np.ndarray
+        desired position of each vehicle
+
+    integral_p_err, integral_v_err : (N, 3) np.ndarray
+        per-vehicle integral errors, updated in place. Zeros if None.
+
+    Returns
+    -------
+    u : (N, 4) np.ndarray
+        control input - (angular velocity)^squared of motors (rad^2/s^2)
+
+    integral_p_err, integral_v_err : (N, 3) np.ndarray
+        updated integral errors, pass back in on the next call
+    """
+    des_vel, integral_p_err = pi_position_control_batch(state, des_pos, integral_p_err)
+    des_thrust, des_theta, integral_v_err = pi_velocity_control_batch(state, des_vel, integral_v_err)
+    u = pi_attitude_control_batch(state, des_theta, des_thrust, param_dict)
+
+    return u, integral_p_err, integral_v_err
+
+
+def pi_position_control_batch(state, des_pos, integral_p_err=None):
+    """Batched pi_position_control(). Returns (N, 3) desired velocity and
+    integral error."""
+    if integral_p_err is None:
+        integral_p_err = np.zeros(state["x"].shape)
+
+    # Same gains as pi_position_control()
+    Px = -0.5
+    Ix = 0  # -0.005
+    Py = -0.5
+    Iy = 0  # 0.005
+    Pz = -1
+
+    p_err = state["x"] - des_pos
+    integral_p_err += p_err
+
+    des_vel = np.empty(p_err.shape)
+    des_vel[:, 0] = Px * p_err[:, 0] + Ix * integral_p_err[:, 0]
+    des_vel[:, 1] = Py * p_err[:, 1] + Iy * integral_p_err[:, 1]
+    des_vel[:, 2] = Pz * p_err[:, 2]
+
+    return des_vel, integral_p_err
+
+
+def pi_velocity_control_batch(state, des_vel, integral_v_err=None):
+    """Batched pi_velocity_control(). Returns (N, ) desired thrust percentage,
+    (N, 3) desired roll, pitch, yaw and integral error."""
+    if integral_v_err is None:
+        integral_v_err = np.zeros(state["xdot"].shape)
+
+    # Same gains as pi_velocity_control()
+    Pxd = -0.12
+    Ixd = -0.005 #-0.005
+    Pyd = -0.12
+    Iyd = -0.005 #0.005
+    Pzd = -0.001
+
+    yaw = state["theta"][:, 2]
+
+    v_err = state["xdot"] - des_vel
+    integral_v_err += v_err
+
+    pid_err_x = Pxd * v_err[:, 0] + Ixd * integral_v_err[:, 0]
+    pid_err_y = Pyd * v_err[:, 1] + Iyd * integral_v_err[:, 1]
+    pid_err_z = Pzd * v_err[:, 2]
+
+    tot_u_constant = 408750 * 4 # hover, for four motors
+    max_tot_u = 400000000.0
+    thrust_pc_constant = tot_u_constant/max_tot_u
+    des_thrust_pc = thrust_pc_constant + pid_err_z
+
+    cos_yaw = np.cos(yaw)
+    sin_yaw = np.sin(yaw)
+    des_theta = np.empty(v_err.shape)
+    des_theta[:, 0] = np.clip(pid_err_x * sin_yaw - pid_err_y * cos_yaw,
+                              np.radians(-30), np.radians(30))
+    des_theta[:, 1] = np.clip(pid_err_x * cos_yaw + pid_err_y * sin_yaw,
+                              np.radians(-30), np.radians(30))
+    des_theta[:, 2] = yaw
+
+    return des_thrust_pc, des_theta, integral_v_err
+
+
+def pi_attitude_control_batch(state, des_theta, des_thrust_pc, param_dict):
+    """Batched pi_attitude_control(). Returns (N, 4) motor input."""
+    # Same gains as pi_attitude_control()
+    Kd = 10
+    Kp = 30
+
+    max_tot_u = 400000000.0
+    tot_u = des_thrust_pc * max_tot_u
+
+    e = Kd * state["thetadot"] + Kp * (state["theta"] - des_theta)
+
+    return angerr2u_batch(e, tot_u, param_dict)
+
+
+def angerr2u_batch(error, tot_thrust, param_dict):
+    """Batched angerr2u(). error is (N, 3), tot_thrust is (N, ). Returns (N, 4)
+    motor input."""
+    L = param_dict["L"]
+    k = param_dict["k"]
+    b = param_dict["b"]
+    I = param_dict["I"]
+
+    e0 = error[:, 0]
+    e1 = error[:, 1]
+    e2 = error[:, 2]
+    Ixx = I[0, 0]
+    Iyy = I[1, 1]
+    Izz = I[2, 2]
+
+    u = np.empty((len(error), 4))
+    u[:, 0] = tot_thrust/4 - (2*b*e0*Ixx + e2*Izz*k*L)/(4*b*k*L)
+    u[:, 1] = tot_thrust/4 + (e2*Izz)/(4*b) - (e1*Iyy)/(2*k*L)
+    u[:, 2] = tot_thrust/4 + (2*b*e0*Ixx - e2*Izz*k*L)/(4*b*k*L)
+    u[:, 3] = tot_thrust/4 + (e2*Izz)/(4*b) + (e1*Iyy)/(2*k*L)
+
+    return u
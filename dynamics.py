@@ -2,8 +2,12 @@
 Simulate Simple Quadrotor Dynamics
 
 `python dynamics.py` to see hovering drone
+`python dynamics.py out.gif` to save it as a GIF instead
 """
 
+import math
+import sys
+import warnings
 import numpy as np
 import numpy.matlib
 from mpl_toolkits import mplot3d
@@ -11,8 +15,14 @@ import matplotlib.pyplot as plt
 from visualize_dynamics import *
 from sim_utils import *
 from controller import *
+from history import HistoryRecorder
 import time
 
+try:
+    import numba
+except ImportError:  # numba is optional, "numba" mode falls back to "fused"
+    numba = None
+
 # Physical constants
 g = -9.81  # FLU
 m = 0.5
@@ -28,27 +38,258 @@ param_dict = {"g": g, "m": m, "L": L, "k": k, "b": b, "I": I,
               "kd": kd, "dt": dt, "maxRPM": maxrpm, "maxthrust": maxthrust}
 
 
+class QuadState:
+    """Quadrotor state stored in one contiguous float64 vector
+    [x, xdot, xdd, theta, thetadot], with named (3, ) views into it.
+
+    Also supports the old state dict interface: state["x"] reads a view and
+    state["x"] = value copies value into the vector. With n_quads, every
+    view is (N, 3) instead, for BatchQuadDynamics.
+    """
+    KEYS = ("x", "xdot", "xdd", "theta", "thetadot")
+    __slots__ = ("vec", "_views")
+
+    def __init__(self, n_quads=None, **values):
+        shape = (15,) if n_quads is None else (n_quads, 15)
+        self.vec = np.zeros(shape)
+        self._views = {key: self.vec[..., 3*i:3*i+3]
+                       for i, key in enumerate(self.KEYS)}
+        for key, val in values.items():
+            self[key] = val
+
+    @classmethod
+    def from_dict(cls, state):
+        """Create from a state dict (any subset of KEYS)."""
+        n_quads = None if np.ndim(state["x"]) == 1 else len(state["x"])
+        return cls(n_quads, **state)
+
+    def to_dict(self):
+        """Copy into a plain state dict."""
+        return {key: view.copy() for key, view in self._views.items()}
+
+    def copy(self):
+        new = QuadState(None if self.vec.ndim == 1 else len(self.vec))
+        new.vec[...] = self.vec
+        return new
+
+    x = property(lambda self: self._views["x"],
+                 lambda self, val: self.__setitem__("x", val))
+    xdot = property(lambda self: self._views["xdot"],
+                    lambda self, val: self.__setitem__("xdot", val))
+    xdd = property(lambda self: self._views["xdd"],
+                   lambda self, val: self.__setitem__("xdd", val))
+    theta = property(lambda self: self._views["theta"],
+                     lambda self, val: self.__setitem__("theta", val))
+    thetadot = property(lambda self: self._views["thetadot"],
+                        lambda self, val: self.__setitem__("thetadot", val))
+
+    # dict interface
+    def __getitem__(self, key):
+        return self._views[key]
+
+    def __setitem__(self, key, val):
+        self._views[key][...] = val
+
+    def get(self, key, default=None):
+        return self._views.get(key, default)
+
+    def __contains__(self, key):
+        return key in self._views
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def keys(self):
+        return self._views.keys()
+
+    def items(self):
+        return self._views.items()
+
+    def __repr__(self):
+        return "QuadState(" + ", ".join(
+            key + "=" + repr(view) for key, view in self._views.items()) + ")"
+
+
 def init_state():
-    """Initialize state dictionary. """
-    state = {"x": np.array([5, 0, 10]),
-             "xdot": np.zeros(3,),
-             "xdd": np.zeros(3,),
-             "theta": np.radians(np.array([0, 0, 0])),  # ! hardcoded
-             "thetadot": np.radians(np.array([0, 0, 0]))  # ! hardcoded
-             }
+    """Initialize state. """
+    state = QuadState(x=np.array([5, 0, 10]),
+                      theta=np.radians(np.array([0, 0, 0])),  # ! hardcoded
+                      thetadot=np.radians(np.array([0, 0, 0]))  # ! hardcoded
+                      )
     return state
 
 
+def fused_step(x, xdot, xdd, theta, thetadot, u, consts):
+    """Step one quadrotor in place, with all of step_dynamics() fused into
+    scalar math and closed-form inverses. Written so numba can compile it.
+
+    Parameters
+    ----------
+    x, xdot, xdd, theta, thetadot : (3, ) float np.ndarray
+        state buffers, overwritten with the next state
+    u : (4, ) np.ndarray
+        control input - (angular velocity)^squared of motors (rad^2/s^2)
+    consts : tuple of float
+        dt, m, g, k, kd, L, b, max u, then I and inv(I) row by row
+    """
+    (dt, m, g, k, kd, L, b, max_u,
+     I00, I01, I02, I10, I11, I12, I20, I21, I22,
+     J00, J01, J02, J10, J11, J12, J20, J21, J22) = consts
+
+    sphi = math.sin(theta[0])
+    cphi = math.cos(theta[0])
+    sthe = math.sin(theta[1])
+    cthe = math.cos(theta[1])
+    spsi = math.sin(theta[2])
+    cpsi = math.cos(theta[2])
+
+    # Angular velocity from euler angle rates
+    td0 = thetadot[0]
+    td1 = thetadot[1]
+    td2 = thetadot[2]
+    w0 = td0 - sthe * td2
+    w1 = cphi * td1 + cthe * sphi * td2
+    w2 = -sphi * td1 + cthe * cphi * td2
+
+    # Linear acceleration: gravity + R * thrust / m + drag
+    u0 = u[0]
+    u1 = u[1]
+    u2 = u[2]
+    u3 = u[3]
+    thrust = k * (min(max(u0, 0.), max_u) + min(max(u1, 0.), max_u) +
+                  min(max(u2, 0.), max_u) + min(max(u3, 0.), max_u))
+    thrust_m = 1/m * thrust
+    a0 = thrust_m * (cphi * sthe * cpsi + sphi * spsi) - kd * xdot[0]
+    a1 = thrust_m * (cphi * sthe * spsi - sphi * cpsi) - kd * xdot[1]
+    a2 = g + thrust_m * (cthe * cphi) - kd * xdot[2]
+
+    # Angular acceleration: inv(I) * (torque - w x (Iw))
+    tau0 = L * k * (u0 - u2)
+    tau1 = L * k * (u1 - u3)
+    tau2 = b * (u0 - u1 + u2 - u3)
+    Iw0 = I00 * w0 + I01 * w1 + I02 * w2
+    Iw1 = I10 * w0 + I11 * w1 + I12 * w2
+    Iw2 = I20 * w0 + I21 * w1 + I22 * w2
+    r0 = tau0 - (w1 * Iw2 - w2 * Iw1)
+    r1 = tau1 - (w2 * Iw0 - w0 * Iw2)
+    r2 = tau2 - (w0 * Iw1 - w1 * Iw0)
+    w0 = w0 + dt * (J00 * r0 + J01 * r1 + J02 * r2)
+    w1 = w1 + dt * (J10 * r0 + J11 * r1 + J12 * r2)
+    w2 = w2 + dt * (J20 * r0 + J21 * r1 + J22 * r2)
+
+    # Euler angle rates from angular velocity (closed-form inverse)
+    tthe = sthe / cthe
+    thetadot[0] = w0 + sphi * tthe * w1 + cphi * tthe * w2
+    thetadot[1] = cphi * w1 - sphi * w2
+    thetadot[2] = (sphi * w1 + cphi * w2) / cthe
+
+    theta[0] = theta[0] + dt * td0
+    theta[1] = theta[1] + dt * td1
+    theta[2] = theta[2] + dt * td2
+    xdd[0] = a0
+    xdd[1] = a1
+    xdd[2] = a2
+    xdot[0] = xdot[0] + dt * a0
+    xdot[1] = xdot[1] + dt * a1
+    xdot[2] = xdot[2] + dt * a2
+    x[0] = x[0] + dt * xdot[0]
+    x[1] = x[1] + dt * xdot[1]
+    x[2] = x[2] + dt * xdot[2]
+
+
+if numba is not None:
+    fused_step_numba = numba.njit(cache=True)(fused_step)
+else:
+    fused_step_numba = None
+
+
+# Dormand-Prince 5(4) tableau for the "rk45" integrator
+_DOPRI_A = np.array([
+    [0, 0, 0, 0, 0, 0],
+    [1/5, 0, 0, 0, 0, 0],
+    [3/40, 9/40, 0, 0, 0, 0],
+    [44/45, -56/15, 32/9, 0, 0, 0],
+    [19372/6561, -25360/2187, 64448/6561, -212/729, 0, 0],
+    [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656, 0],
+    [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84]])
+_DOPRI_B = np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84, 0])
+_DOPRI_E = _DOPRI_B - np.array([5179/57600, 0, 7571/16695, 393/640,
+                                -92097/339200, 187/2100, 1/40])
+
+
 class QuadDynamics:
-    def __init__(self):
-        self.param_dict = param_dict
+    """Simple 3d quadrotor dynamics.
+
+    mode : "numpy" steps with the reference numpy implementation.
+           "fused" steps with fused_step(), updating state arrays in place.
+           "numba" compiles fused_step() with numba, or falls back to
+           "fused" if numba is not installed.
+
+    integrator : "euler" is the original explicit scheme, in every mode.
+                 "semi_implicit" updates velocities first, then positions
+                 and angles with the new velocities.
+                 "rk4" is classic 4th order Runge-Kutta.
+                 "rk45" is adaptive Dormand-Prince, taking as many substeps
+                 per dt as rtol and atol require.
+                 All but "euler" integrate y = [x, xdot, theta, omega] (see
+                 deriv()) and need mode "numpy". They converge to the same
+                 solution as dt shrinks.
+
+    Warning: "euler" solves a different ODE. It carries thetadot (not the
+    body rate omega) between steps and drops the time derivative of the
+    angular velocity transform, so it does not converge to the rigid-body
+    solution of the other integrators as dt shrinks (with the slightly
+    unbalanced hover input of test_dynamics.py its final pose stays about
+    0.08 away after 1 s and 1.1 after 2 s, at any dt). Switching integrator changes the simulated physics, it does
+    not just reproduce a fine-step "euler" run at a larger dt.
+    See test_dynamics.py.
+    """
+    MODES = ("numpy", "fused", "numba")
+    INTEGRATORS = ("euler", "semi_implicit", "rk4", "rk45")
+
+    def __init__(self, mode="numpy", dt=dt, integrator="euler", rtol=1e-6, atol=1e-8,
+                 max_substeps=10000):
+        """dt : integration time step (s)
+        rtol, atol : relative and absolute error tolerance per substep of "rk45"
+        max_substeps : "rk45" raises RuntimeError when a step takes more
+                       (accepted and rejected) substeps
+        """
+        if mode not in self.MODES:
+            raise ValueError("Unknown dynamics mode " + str(mode) +
+                             ", expected one of " + str(self.MODES))
+        if integrator not in self.INTEGRATORS:
+            raise ValueError("Unknown integrator " + str(integrator) +
+                             ", expected one of " + str(self.INTEGRATORS))
+        if integrator != "euler" and mode != "numpy":
+            raise ValueError("Integrator " + integrator + " needs mode numpy")
+        self.integrator = integrator
+        self.rtol = rtol
+        self.atol = atol
+        self.max_substeps = max_substeps
+        self.rk45_h = dt  # substep size, carried over between steps
+        self.n_substeps = 0  # substeps taken by the last "rk45" step
+        self.n_rejected = 0  # substeps rejected by the last "rk45" step
+        if mode == "numba" and fused_step_numba is None:
+            warnings.warn("numba is not installed, using fused dynamics")
+            mode = "fused"
+        self.mode = mode
+        self.dt = dt
+        self.param_dict = dict(param_dict, dt=dt)
+        self.fused_consts = tuple(float(c) for c in
+                                  [dt, m, g, k, kd, L, b, param_dict["maxRPM"]**2] +
+                                  list(np.ravel(I)) + list(np.linalg.inv(I).ravel()))
 
     def step_dynamics(self, state, u):
         """Step dynamics given current state and input. Updates state dict.
+        In "fused" and "numba" modes the state arrays are updated in place
+        (after a one-time conversion to float64 buffers).
         
         Parameters
         ----------
-        state : dict 
+        state : QuadState or dict 
             contains current x, xdot, theta, thetadot
 
         u : (4, ) np.ndarray
@@ -56,9 +297,14 @@ class QuadDynamics:
 
         Updates
         -------
-        state : dict 
+        state : QuadState or dict 
             updates with next x, xdot, xdd, theta, thetadot  
         """
+        if self.mode != "numpy":
+            return self.step_dynamics_fused(state, u)
+        if self.integrator != "euler":
+            return self.step_dynamics_integrator(state, u)
+
         # Compute angular velocity vector from angular velocities
         omega = self.thetadot2omega(state["thetadot"], state["theta"])
 
@@ -67,6 +313,7 @@ class QuadDynamics:
         omegadot = self.calc_ang_acc(u, omega, I, L, b, k)
 
         # Compute next state
+        dt = self.dt
         omega = omega + dt * omegadot
         thetadot = self.omega2thetadot(omega, state["theta"])
         theta = state["theta"] + dt * state["thetadot"]
@@ -82,6 +329,138 @@ class QuadDynamics:
 
         return state
 
+    def deriv(self, y, u):
+        """Time derivative of y = [x, xdot, theta, omega] (12, ) given input u,
+        omega being the body angular velocity vector."""
+        theta = y[6:9]
+        omega = y[9:12]
+        dy = np.empty(12)
+        dy[0:3] = y[3:6]
+        dy[3:6] = self.calc_acc(u, theta, y[3:6], m, g, k, kd)
+        dy[6:9] = self.omega2thetadot(omega, theta)
+        dy[9:12] = self.calc_ang_acc(u, omega, I, L, b, k)
+        return dy
+
+    def step_dynamics_integrator(self, state, u):
+        """step_dynamics() with the "semi_implicit", "rk4" or "rk45" integrator."""
+        omega = self.thetadot2omega(state["thetadot"], state["theta"])
+        y = np.concatenate((state["x"], state["xdot"], state["theta"], omega))
+        a = self.calc_acc(u, state["theta"], state["xdot"], m, g, k, kd)
+        if self.integrator == "semi_implicit":
+            y_next = self.semi_implicit_step(y, u, self.dt)
+        elif self.integrator == "rk4":
+            y_next = self.rk4_step(y, u, self.dt)
+        else:
+            y_next = self.rk45_step(y, u, self.dt)
+
+        state["x"] = y_next[0:3]
+        state["xdot"] = y_next[3:6]
+        state["xdd"] = a
+        state["theta"] = y_next[6:9]
+        state["thetadot"] = self.omega2thetadot(y_next[9:12], y_next[6:9])
+        return state
+
+    def semi_implicit_step(self, y, u, h):
+        """Semi-implicit Euler: velocities from current accelerations, then
+        positions and angles from the new velocities."""
+        dy = self.deriv(y, u)
+        y_next = np.empty(12)
+        y_next[3:6] = y[3:6] + h * dy[3:6]
+        y_next[9:12] = y[9:12] + h * dy[9:12]
+        y_next[0:3] = y[0:3] + h * y_next[3:6]
+        y_next[6:9] = y[6:9] + h * self.omega2thetadot(y_next[9:12], y[6:9])
+        return y_next
+
+    def rk4_step(self, y, u, h):
+        """Classic 4th order Runge-Kutta step, u held constant."""
+        k1 = self.deriv(y, u)
+        k2 = self.deriv(y + 0.5 * h * k1, u)
+        k3 = self.deriv(y + 0.5 * h * k2, u)
+        k4 = self.deriv(y + h * k3, u)
+        return y + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+
+    def rk45_step(self, y, u, dt):
+        """Integrate over dt with adaptive Dormand-Prince 5(4) substeps. The
+        substep size is kept for the next call."""
+        t = 0.
+        h = self.rk45_h
+        K = np.empty((7, 12))
+        K[0] = self.deriv(y, u)
+        self.n_substeps = 0
+        self.n_rejected = 0
+        while t < dt:
+            last = h >= dt - t
+            h_step = dt - t if last else h
+            for i in range(1, 7):
+                K[i] = self.deriv(y + h_step * np.dot(_DOPRI_A[i, :i], K[:i]), u)
+            y_new = y + h_step * np.dot(_DOPRI_A[6, :6], K[:6])
+            err = h_step * np.dot(_DOPRI_E, K)
+            scale = self.atol + self.rtol * np.maximum(np.abs(y), np.abs(y_new))
+            err_norm = np.sqrt(np.mean((err / scale)**2))
+            factor = min(5., max(0.2, 0.9 * (err_norm + 1e-16)**-0.2))
+
+            if err_norm <= 1:
+                t = dt if last else t + h_step
+                y = y_new
+                K[0] = K[6]  # first same as last
+                self.n_substeps += 1
+                if not last:  # a substep clipped to dt says nothing about h
+                    h = h * factor
+            else:
+                self.n_rejected += 1
+                h = h_step * factor
+            if self.n_substeps + self.n_rejected >= self.max_substeps:
+                self.rk45_h = dt
+                raise RuntimeError("rk45 took " + str(self.max_substeps) +
+                                   " substeps in one step, the state is likely diverging")
+        self.rk45_h = h
+        return y
+
+    def step_dynamics_fused(self, state, u):
+        """Step dynamics with the fused kernel, writing into the state arrays."""
+        if isinstance(state, QuadState):
+            return self._step_quad_state_fused(state, u)
+
+        for key in ("x", "xdot", "xdd", "theta", "thetadot"):
+            buf = state.get(key)
+            if buf is None or buf.dtype != np.float64 or buf.shape != (3,):
+                state[key] = np.zeros(3) if buf is None else np.array(buf, dtype=np.float64)
+        x = state["x"]
+        xdot = state["xdot"]
+        xdd = state["xdd"]
+        theta = state["theta"]
+        thetadot = state["thetadot"]
+
+        if self.mode == "numba":
+            fused_step_numba(x, xdot, xdd, theta, thetadot,
+                             np.asarray(u, dtype=np.float64), self.fused_consts)
+            return state
+
+        # Plain python floats are much faster than numpy scalars here
+        bufs = [x.tolist(), xdot.tolist(), [0., 0., 0.], theta.tolist(), thetadot.tolist()]
+        fused_step(*bufs, np.asarray(u, dtype=np.float64).tolist(), self.fused_consts)
+        x[:] = bufs[0]
+        xdot[:] = bufs[1]
+        xdd[:] = bufs[2]
+        theta[:] = bufs[3]
+        thetadot[:] = bufs[4]
+        return state
+
+    def _step_quad_state_fused(self, state, u):
+        """step_dynamics_fused() for QuadState, reading and writing its
+        vector in one go."""
+        if self.mode == "numba":
+            fused_step_numba(state.x, state.xdot, state.xdd, state.theta,
+                             state.thetadot, np.asarray(u, dtype=np.float64),
+                             self.fused_consts)
+            return state
+
+        v = state.vec.tolist()
+        bufs = [v[0:3], v[3:6], v[6:9], v[9:12], v[12:15]]
+        fused_step(*bufs, np.asarray(u, dtype=np.float64).tolist(), self.fused_consts)
+        state.vec[:] = bufs[0] + bufs[1] + bufs[2] + bufs[3] + bufs[4]
+        return state
+
     def compute_thrust(self, u, k):
         """Compute total thrust (in body frame) given control input and thrust coefficient. Used in calc_acc().
         Clips if above maximum rpm (10000).
@@ -275,51 +654,163 @@ class QuadDynamics:
         return w
 
 
+def init_batch_state(n_quads):
+    """Initialize state for n_quads quadrotors, with (N, 3) views and the
+    same keys as init_state()."""
+    state = QuadState(n_quads)
+    state.vec[:] = init_state().vec
+    return state
+
+
+class BatchQuadDynamics:
+    """Steps N quadrotors at once. Same dynamics as QuadDynamics, but the state
+    dict holds (N, 3) arrays and the input is (N, 4). Every vehicle gives the
+    same result as stepping it alone with QuadDynamics."""
+
+    def __init__(self, dt=dt):
+        self.dt = dt
+        self.param_dict = dict(param_dict, dt=dt)
+        self.I_inv = np.linalg.inv(I)
+
+    def step_dynamics(self, state, u):
+        """Step dynamics of all vehicles given current states and inputs.
+
+        Parameters
+        ----------
+        state : QuadState or dict
+            contains current x, xdot, theta, thetadot, each (N, 3) np.ndarray
+
+        u : (N, 4) np.ndarray
+            control input - (angular velocity)^squared of motors (rad^2/s^2)
+
+        Updates
+        -------
+        state : dict
+            updates with next x, xdot, xdd, theta, thetadot
+        """
+        omega = self.thetadot2omega(state["thetadot"], state["theta"])
+
+        a = self.calc_acc(u, state["theta"], state["xdot"], m, g, k, kd)
+        omegadot = self.calc_ang_acc(u, omega, L, b, k)
+
+        dt = self.dt
+        omega = omega + dt * omegadot
+        thetadot = self.omega2thetadot(omega, state["theta"])
+        theta = state["theta"] + dt * state["thetadot"]
+        xdot = state["xdot"] + dt * a
+        x = state["x"] + dt * xdot
+
+        state["x"] = x
+        state["xdot"] = xdot
+        state["xdd"] = a
+        state["theta"] = theta
+        state["thetadot"] = thetadot
+
+        return state
+
+    def compute_thrust(self, u, k):
+        """Batched QuadDynamics.compute_thrust(). Returns (N, 3) body thrust."""
+        u = np.clip(u, 0, self.param_dict["maxRPM"]**2)
+        T = np.zeros((len(u), 3))
+        T[:, 2] = k * np.sum(u, axis=1)
+        return T
+
+    def calc_torque(self, u, L, b, k):
+        """Batched QuadDynamics.calc_torque(). Returns (N, 3) body torque."""
+        tau = np.empty((len(u), 3))
+        tau[:, 0] = L * k * (u[:, 0]-u[:, 2])
+        tau[:, 1] = L * k * (u[:, 1]-u[:, 3])
+        tau[:, 2] = b * (u[:, 0]-u[:, 1] + u[:, 2]-u[:, 3])
+        return tau
+
+    def calc_acc(self, u, theta, xdot, m, g, k, kd):
+        """Batched QuadDynamics.calc_acc(). Returns (N, 3) inertial acceleration."""
+        gravity = np.array([0, 0, g])
+        R = get_rot_matrices(theta)
+        thrust = self.compute_thrust(u, k)
+        T = np.matmul(R, thrust[:, :, None])[:, :, 0]
+        Fd = -kd * xdot
+        a = gravity + 1/m * T + Fd
+        return a
+
+    def calc_ang_acc(self, u, omega, L, b, k):
+        """Batched QuadDynamics.calc_ang_acc(). Returns (N, 3) body angular
+        acceleration, using the inverse inertia computed once in __init__."""
+        tau = self.calc_torque(u, L, b, k)
+        Iw = np.matmul(I, omega[:, :, None])[:, :, 0]
+        omegaddot = np.matmul(
+            self.I_inv, (tau - np.cross(omega, Iw))[:, :, None])[:, :, 0]
+        return omegaddot
+
+    def euler_rate_matrices(self, theta):
+        """(N, 3, 3) matrices mapping euler angle rates to angular velocity."""
+        mult_matrix = np.zeros((len(theta), 3, 3))
+        mult_matrix[:, 0, 0] = 1
+        mult_matrix[:, 0, 2] = -np.sin(theta[:, 1])
+        mult_matrix[:, 1, 1] = np.cos(theta[:, 0])
+        mult_matrix[:, 1, 2] = np.cos(theta[:, 1])*np.sin(theta[:, 0])
+        mult_matrix[:, 2, 1] = -np.sin(theta[:, 0])
+        mult_matrix[:, 2, 2] = np.cos(theta[:, 1])*np.cos(theta[:, 0])
+        return mult_matrix
+
+    def omega2thetadot(self, omega, theta):
+        """Batched QuadDynamics.omega2thetadot()."""
+        mult_inv = np.linalg.inv(self.euler_rate_matrices(theta))
+        return np.matmul(mult_inv, omega[:, :, None])[:, :, 0]
+
+    def thetadot2omega(self, thetadot, theta):
+        """Batched QuadDynamics.thetadot2omega()."""
+        mult_matrix = self.euler_rate_matrices(theta)
+        return np.matmul(mult_matrix, thetadot[:, :, None])[:, :, 0]
+
+
 def basic_input():
     """Return arbritrary input to test simulator"""
     return np.power(np.array([950, 700, 700, 700]), 2)
 
 
 class QuadHistory():
-    """Keeps track of quadrotor history for plotting."""
-
-    def __init__(self):
-        self.hist_theta = []
-        self.hist_des_theta = []
-        self.hist_thetadot = []
-        self.hist_xdot = [[0, 0, 0]]
-        self.hist_xdotdot = []
-        self.hist_x = []
-        self.hist_y = []
-        self.hist_z = []
-        self.hist_pos = []
-        self.hist_des_xdot = []
-        self.hist_des_x = []
+    """Keeps track of quadrotor history for plotting.
+
+    Backed by a HistoryRecorder; hist_* attributes are views of its columns.
+    Keyword arguments (capacity, ring, decimation, dtype) are passed on.
+    """
+
+    def __init__(self, **recorder_kwargs):
+        self.recorder = HistoryRecorder(
+            {"theta": 3, "des_theta": 3, "thetadot": 3, "xdot": 3, "xdotdot": 3,
+             "pos": 3, "des_xdot": 3, "des_x": 3}, **recorder_kwargs)
+
+    def __len__(self):
+        return len(self.recorder)
+
+    hist_theta = property(lambda self: self.recorder["theta"])
+    hist_des_theta = property(lambda self: self.recorder["des_theta"])
+    hist_thetadot = property(lambda self: self.recorder["thetadot"])
+    hist_xdot = property(lambda self: self.recorder["xdot"])
+    hist_xdotdot = property(lambda self: self.recorder["xdotdot"])
+    hist_pos = property(lambda self: self.recorder["pos"])
+    hist_x = property(lambda self: self.recorder["pos"][:, 0])
+    hist_y = property(lambda self: self.recorder["pos"][:, 1])
+    hist_z = property(lambda self: self.recorder["pos"][:, 2])
+    hist_des_xdot = property(lambda self: self.recorder["des_xdot"])
+    hist_des_x = property(lambda self: self.recorder["des_x"])
 
     def update_history(self, state, des_theta_deg_i, des_xdot_i, des_x_i, dt):
-        """Appends current state and desired theta for plotting."""
-        x = state["x"]
-        xdot = state["xdot"]
-        xdotdot = (xdot - np.array(self.hist_xdot[-1])) / dt
-        self.hist_x.append(x[0])
-        self.hist_y.append(x[1])
-        self.hist_z.append(x[2])
-        self.hist_theta.append(np.degrees(state["theta"]))
-        self.hist_thetadot.append(np.degrees(state["thetadot"]))
-        # if des_xdot_i is None:
-        #     des_xdot_i = [0,0,0]
-        # if des_x_i is None:
-        #     des_x_i = [0, 0, 0]
-        self.hist_des_theta.append(des_theta_deg_i)
-        self.hist_xdot.append(state["xdot"])
-        self.hist_des_xdot.append(des_xdot_i)
-        self.hist_des_x.append(des_x_i)
-        self.hist_pos.append(x)
-
-        self.hist_xdotdot.append(state["xdd"])
-
-
-def main():
+        """Records current state and desired theta for plotting."""
+        self.recorder.append(theta=np.degrees(state["theta"]),
+                             des_theta=des_theta_deg_i,
+                             thetadot=np.degrees(state["thetadot"]),
+                             xdot=state["xdot"],
+                             xdotdot=state["xdd"],
+                             pos=state["x"],
+                             des_xdot=des_xdot_i,
+                             des_x=des_x_i)
+
+
+def main(out_path=None):
+    """out_path : write the replay to this .gif (or video) file instead of
+    showing it"""
     print("start")
     t_start = time.time()
 
@@ -332,21 +823,12 @@ def main():
     # Initialize quadrotor history tracker
     quad_hist = QuadHistory()
 
-    # Initialize visualization
-    fig = plt.figure()
-    ax = fig.add_subplot(2, 3, 1, projection='3d')
-    ax_x_error = fig.add_subplot(2, 3, 2)
-    ax_xd_error = fig.add_subplot(2, 3, 3)
-    ax_xdd_error = fig.add_subplot(2, 3, 4)
-    ax_th_error = fig.add_subplot(2, 3, 5)
-    ax_thr_error = fig.add_subplot(2, 3, 6)
-
     # Initialize controller errors
     integral_p_err = None
     integral_v_err = None
 
     # Initialize quad dynamics
-    quad_dyn = QuadDynamics()
+    quad_dyn = QuadDynamics(mode="fused")
 
     sim_iter = 100
     # Step through simulation
@@ -354,7 +836,6 @@ def main():
 
         if t * dt > 20:
             des_pos = np.array([0, 0, 10])
-        ax.cla()
         des_vel, integral_p_err = pi_position_control(
             state, des_pos, integral_p_err)
         des_thrust, des_theta, integral_v_err = pi_velocity_control(
@@ -367,15 +848,15 @@ def main():
         # update history for plotting
         quad_hist.update_history(state, des_theta_deg, des_vel, des_pos, dt)
 
-    for t in range(100):
-    # # Visualize quadrotor and angle error
-        ax.cla()
-        visualize_quad_quadhist(ax, quad_hist, t)
-        visualize_error_quadhist(
-            ax_x_error, ax_xd_error, ax_th_error, ax_thr_error, ax_xdd_error, quad_hist, t, dt)
+    # Visualize quadrotor and angle error
+    dashboard = QuadDashboard(quad_hist, dt)
+    if out_path is None:
+        dashboard.play()
+    else:
+        dashboard.save(out_path)
 
     print("Time Elapsed:", time.time() - t_start)
 
 
 if __name__ == '__main__':
-    main()
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
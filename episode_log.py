@@ -0,0 +1,337 @@
+"""episode_log.py
+Chunked, compressed, append-only binary log of simulation episodes.
+
+Per-step columns are buffered into fixed-size chunks of chunk_rows rows and
+written (optionally zlib compressed) as soon as a chunk fills, so memory
+stays flat however long an episode runs. Several episodes may be open at
+once, their chunks interleave in the file.
+
+File layout (little endian):
+
+    header   MAGIC, uint32 n, n bytes of JSON (columns, dtype, chunk_rows)
+    chunk    CHUNK_HEADER (b"CHNK", episode, start step, rows, nbytes,
+             compressed) then nbytes of payload: every column's rows in
+             column order, each a C-ordered (rows, width) array of dtype
+    ...
+    footer   JSON (episode metadata and the chunk index)
+    trailer  TRAILER (footer offset, footer nbytes, INDEX_MAGIC)
+
+The reader memory-maps the file and uses the index to decode only the
+chunks overlapping a requested step range. If the footer is missing (the
+writer did not close), the index is rebuilt by skipping from chunk header
+to chunk header, without decoding any payload.
+"""
+
+import json
+import mmap
+import os
+import struct
+import zlib
+
+import numpy as np
+
+MAGIC = b"EPLOG001"
+INDEX_MAGIC = b"EPINDEX1"
+CHUNK_MAGIC = b"CHNK"
+CHUNK_HEADER = struct.Struct("<4sIQIIB")  # magic, episode, start, rows, nbytes, compressed
+TRAILER = struct.Struct("<QQ8s")          # footer offset, footer nbytes, INDEX_MAGIC
+INDEX_FIELDS = ("episode", "start", "rows", "offset", "nbytes", "compressed")
+
+
+def robot_columns(n_beams):
+    """Columns logged by robot_row() for a robot with n_beams lidar beams."""
+    return {"state": 15, "ranges": n_beams, "controls": 6, "clearance": 1}
+
+
+def robot_row(robot, clearance):
+    """One log row of a Robot after update(): full quadrotor state vector,
+    lidar ranges, original / safe / final control and clearance."""
+    pos_cont = robot.pos_cont
+    ranges = robot.lidar.ranges
+    return {"state": robot.state.vec,
+            "ranges": np.nan if ranges is None else ranges,
+            "controls": np.concatenate((pos_cont.og_control, pos_cont.safe_control,
+                                        (pos_cont.u_x, pos_cont.u_y))),
+            "clearance": clearance}
+
+
+def _read_header(buf):
+    """Returns (header dict, offset of the first chunk)."""
+    if bytes(buf[:len(MAGIC)]) != MAGIC:
+        raise ValueError("Not an episode log")
+    n, = struct.unpack_from("<I", buf, len(MAGIC))
+    start = len(MAGIC) + 4
+    return json.loads(bytes(buf[start:start + n]).decode()), start + n
+
+
+def _read_footer(buf):
+    """Returns the footer dict and its offset, or (None, None) if the file
+    has no valid trailer."""
+    if len(buf) < TRAILER.size:
+        return None, None
+    offset, nbytes, magic = TRAILER.unpack_from(buf, len(buf) - TRAILER.size)
+    if magic != INDEX_MAGIC or offset + nbytes + TRAILER.size != len(buf):
+        return None, None
+    return json.loads(bytes(buf[offset:offset + nbytes]).decode()), offset
+
+
+def _scan_chunks(buf, offset):
+    """Rebuild the chunk index from chunk headers, starting at offset.
+    Returns (index rows, end of the last complete chunk)."""
+    index = []
+    while offset + CHUNK_HEADER.size <= len(buf):
+        magic, episode, start, rows, nbytes, compressed = CHUNK_HEADER.unpack_from(buf, offset)
+        end = offset + CHUNK_HEADER.size + nbytes
+        if magic != CHUNK_MAGIC or end > len(buf):
+            break
+        index.append([episode, start, rows, offset + CHUNK_HEADER.size, nbytes, compressed])
+        offset = end
+    return index, offset
+
+
+class EpisodeLogWriter():
+    """Streams episodes to an episode log file.
+
+    Parameters
+    ----------
+    path : str
+    columns : dict
+        column name -> width, ex. robot_columns(n_beams). Width 1 gives
+        (T, ) columns when read, otherwise (T, width).
+    chunk_rows : int
+        rows per chunk, the unit of writing, compression and random access
+    compression : int
+        zlib level 0-9, 0 stores chunks uncompressed
+    dtype : np.dtype
+        storage type of all columns
+    append : bool
+        add episodes to an existing log (columns and dtype must match)
+        instead of overwriting it
+
+    Use as a context manager, or call close() to write the index.
+    """
+
+    def __init__(self, path, columns, chunk_rows=256, compression=6, dtype=np.float32,
+                 append=False):
+        if chunk_rows < 1:
+            raise ValueError("chunk_rows must be positive")
+        if not 0 <= compression <= 9:
+            raise ValueError("compression must be a zlib level 0-9")
+        self.path = path
+        self.widths = dict(columns)
+        self.chunk_rows = chunk_rows
+        self.compression = compression
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self.episodes = []   # metadata dict per episode
+        self.index = []      # INDEX_FIELDS per chunk
+        self.lengths = []    # rows per episode
+        self.open_episodes = {}  # episode -> {column: (chunk_rows, width) buffer}
+
+        header = {"columns": self.widths, "dtype": self.dtype.str, "chunk_rows": chunk_rows}
+        if append and os.path.exists(path) and os.path.getsize(path) > 0:
+            self.file = open(path, "r+b")
+            self._load_existing(header)
+        else:
+            self.file = open(path, "wb")
+            header_bytes = json.dumps(header).encode()
+            self.file.write(MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes)
+
+    def _load_existing(self, header):
+        """Read the episodes and index of an existing log and position the
+        file to overwrite its footer."""
+        with mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            old_header, first_chunk = _read_header(buf)
+            if old_header["columns"] != header["columns"] or old_header["dtype"] != header["dtype"]:
+                raise ValueError("Columns or dtype do not match the existing log")
+            footer, end = _read_footer(buf)
+            if footer is None:
+                index, end = _scan_chunks(buf, first_chunk)
+                n_episodes = max([row[0] for row in index], default=-1) + 1
+                footer = {"episodes": [{} for i in range(n_episodes)], "index": index}
+        self.episodes = footer["episodes"]
+        self.index = footer["index"]
+        self.lengths = [0] * len(self.episodes)
+        for row in self.index:
+            self.lengths[row[0]] = max(self.lengths[row[0]], row[1] + row[2])
+        self.file.seek(end)
+        self.file.truncate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def begin_episode(self, **meta):
+        """Start a new episode, returns its id. meta (JSON serializable) is
+        stored in the index, ex. map name, start pose and seed."""
+        episode = len(self.episodes)
+        self.episodes.append(meta)
+        self.lengths.append(0)
+        self.open_episodes[episode] = {
+            name: np.empty((self.chunk_rows, width), dtype=self.dtype)
+            for name, width in self.widths.items()}
+        return episode
+
+    def append(self, episode, **values):
+        """Add one step to an open episode, with a value for every column."""
+        buffers = self.open_episodes[episode]
+        row = self.lengths[episode] % self.chunk_rows
+        for name, buf in buffers.items():
+            buf[row] = values[name]
+        self.lengths[episode] += 1
+        if row == self.chunk_rows - 1:
+            self._write_chunk(episode, self.chunk_rows)
+
+    def end_episode(self, episode):
+        """Write the last, partial chunk of an episode and close it."""
+        rows = self.lengths[episode] % self.chunk_rows
+        if rows:
+            self._write_chunk(episode, rows)
+        del self.open_episodes[episode]
+
+    def _write_chunk(self, episode, rows):
+        buffers = self.open_episodes[episode]
+        payload = b"".join(buffers[name][:rows].tobytes() for name in self.widths)
+        compressed = self.compression > 0
+        if compressed:
+            payload = zlib.compress(payload, self.compression)
+        start = self.lengths[episode] - rows
+        offset = self.file.tell()
+        self.file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, episode, start, rows, len(payload),
+                                          compressed))
+        self.file.write(payload)
+        self.index.append([episode, start, rows, offset + CHUNK_HEADER.size, len(payload),
+                           int(compressed)])
+
+    def flush(self):
+        """Flush written chunks to disk. Rows of unfinished chunks stay buffered."""
+        self.file.flush()
+
+    def close(self):
+        """End all open episodes and write the index."""
+        if self.file.closed:
+            return
+        for episode in list(self.open_episodes):
+            self.end_episode(episode)
+        footer = json.dumps({"episodes": self.episodes, "index": self.index}).encode()
+        offset = self.file.tell()
+        self.file.write(footer)
+        self.file.write(TRAILER.pack(offset, len(footer), INDEX_MAGIC))
+        self.file.close()
+
+
+class EpisodeLogReader():
+    """Random access to the episodes of an episode log.
+
+    The file is memory-mapped. read() decodes only the chunks that overlap
+    the requested steps; uncompressed chunks are not copied until sliced
+    together.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        header, first_chunk = _read_header(self.buf)
+        self.widths = header["columns"]
+        self.dtype = np.dtype(header["dtype"])
+        self.chunk_rows = header["chunk_rows"]
+
+        footer, _ = _read_footer(self.buf)
+        self.complete = footer is not None
+        if footer is None:
+            index, _ = _scan_chunks(self.buf, first_chunk)
+            n_episodes = max([row[0] for row in index], default=-1) + 1
+            footer = {"episodes": [{} for i in range(n_episodes)], "index": index}
+        self.episodes = footer["episodes"]
+        index = np.array(footer["index"], dtype=np.int64).reshape(-1, len(INDEX_FIELDS))
+        self.index = {name: index[:, i] for i, name in enumerate(INDEX_FIELDS)}
+
+        # chunk numbers of every episode, in step order
+        order = np.lexsort((self.index["start"], self.index["episode"]))
+        bounds = np.searchsorted(self.index["episode"][order], np.arange(len(self.episodes) + 1))
+        self.episode_chunks = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.episodes))]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.buf.close()
+        self.file.close()
+
+    def __len__(self):
+        """Number of episodes."""
+        return len(self.episodes)
+
+    def meta(self, episode):
+        return self.episodes[episode]
+
+    def episode_length(self, episode):
+        chunks = self.episode_chunks[episode]
+        if len(chunks) == 0:
+            return 0
+        last = chunks[-1]
+        return int(self.index["start"][last] + self.index["rows"][last])
+
+    def read_chunk(self, chunk, columns=None):
+        """Decode chunk number chunk into {column: (rows, width) array}."""
+        offset = int(self.index["offset"][chunk])
+        payload = memoryview(self.buf)[offset:offset + int(self.index["nbytes"][chunk])]
+        if self.index["compressed"][chunk]:
+            payload = zlib.decompress(payload)
+        rows = int(self.index["rows"][chunk])
+        out = {}
+        pos = 0
+        for name, width in self.widths.items():
+            n = rows * width
+            if columns is None or name in columns:
+                out[name] = np.frombuffer(payload, dtype=self.dtype, count=n,
+                                          offset=pos).reshape(rows, width)
+            pos += n * self.dtype.itemsize
+        return out
+
+    def read(self, episode, columns=None, start=0, stop=None):
+        """Steps start to stop of an episode.
+
+        Parameters
+        ----------
+        episode : int
+        columns : list of str or None
+            columns to decode, all if None
+        start, stop : int
+            step range, stop=None reads to the end
+
+        Returns
+        -------
+        data : dict
+            column name -> (stop - start, ) or (stop - start, width) np.ndarray
+        """
+        length = self.episode_length(episode)
+        stop = length if stop is None else min(stop, length)
+        start = max(start, 0)
+        names = [name for name in self.widths if columns is None or name in columns]
+        out = {name: np.empty((max(stop - start, 0), self.widths[name]), dtype=self.dtype)
+               for name in names}
+
+        chunks = self.episode_chunks[episode]
+        starts = self.index["start"][chunks]
+        first = max(np.searchsorted(starts, start, side="right") - 1, 0)
+        last = np.searchsorted(starts, stop, side="left")
+        for chunk in chunks[first:last]:
+            chunk_start = int(self.index["start"][chunk])
+            lo = max(start, chunk_start)
+            hi = min(stop, chunk_start + int(self.index["rows"][chunk]))
+            if lo >= hi:
+                continue
+            data = self.read_chunk(chunk, names)
+            for name in names:
+                out[name][lo - start:hi - start] = data[name][lo - chunk_start:hi - chunk_start]
+
+        for name in names:
+            if self.widths[name] == 1:
+                out[name] = out[name][:, 0]
+        return out
@@ -5,6 +5,7 @@ Contains functions to evaluate safe control methods. Should contain multiple met
 
 """
 from simulator import Map, LidarSimulator, Robot
+from episode_log import EpisodeLogWriter, robot_columns, robot_row
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
@@ -13,22 +14,100 @@ import random
 
 color_cycle = plt.rcParams['axes.prop_cycle'].by_key()['color']
 
-def distance_to_closest_obstacle(dense_lidar, robot):
-    """Input: state, maps.
+def distance_to_closest_obstacle(robot, dense_lidar=None):
+    """Input: robot (with map), optional dense lidar.
        Output: closest distance (m)
+
+    Looks up the map's distance field by default. If dense_lidar is given,
+    uses the minimum range of a scan instead. A "visibility" lidar gives the
+    exact closest obstacle point, independent of its number of beams.
     """
-    dense_lidar.update_reading((robot.x, robot.y))
+    if dense_lidar is None:
+        return robot.map.distance_to_obstacle((robot.x, robot.y))
+    if dense_lidar.method == "visibility":
+        return dense_lidar.visibility_polygon((robot.x, robot.y)).closest_point()[0]
+    dense_lidar.update_reading((robot.x, robot.y), robot.state["theta"][2])
     return np.min(dense_lidar.ranges)
 
-def main():
+def is_in_collision(map1, pos):
+    """True if pos lies in an occupied cell. Outside the map is free."""
+    return bool(map1.is_occupied(int(pos[0]), int(pos[1])))
+
+
+def run_episode(map1, start_pos=(50, 10), use_safe=True, lidar_angles=None, steps=100,
+                seed=None, start_noise=0.0, skip_scans=False, log=None):
+    """Run one robot headless and return its metrics as a dict.
+
+    Parameters
+    ----------
+    map1 : Map
+    start_pos : (x, y) or (x, y, yaw in deg)
+    use_safe : bool
+        run safe control on top of original control
+    lidar_angles : array-like or None
+        robot lidar beam angles (deg), LidarSimulator default if None
+    steps : int
+        number of Robot.update() calls
+    seed : int or None
+        seeds start position noise
+    start_noise : float
+        std. dev. of gaussian noise added to the start (x, y)
+    skip_scans : bool
+        reuse lidar scans while far from obstacles (see Robot)
+    log : EpisodeLogWriter or None
+        streams every step (robot_row()) to the log as a new episode. Its
+        columns must be robot_columns() of the robot's lidar.
+
+    Returns
+    -------
+    metrics : dict
+        min_clearance, mean_clearance, collision_step (None if no collision),
+        final_pos, steps, scans and skipped_scans
+    """
+    rng = np.random.default_rng(seed)
+    start_pos = np.array(start_pos, dtype=float)
+    start_pos[:2] += rng.normal(scale=start_noise, size=2) if start_noise else 0
+
+    if lidar_angles is None:
+        lidar = None
+    else:
+        lidar = LidarSimulator(map1, angles=np.asarray(lidar_angles, dtype=float))
+    robot = Robot(map1, lidar=lidar, use_safe=use_safe, start_pos=start_pos,
+                  skip_scans=skip_scans)
+
+    if log is not None:
+        episode = log.begin_episode(start_pos=start_pos.tolist(), use_safe=use_safe,
+                                    steps=steps, seed=None if seed is None else int(seed),
+                                    skip_scans=skip_scans)
+
+    clearance = np.empty(steps)
+    collision_step = None
+    for i in range(steps):
+        robot.update()
+        clearance[i] = distance_to_closest_obstacle(robot)
+        if collision_step is None and is_in_collision(map1, (robot.x, robot.y)):
+            collision_step = i
+        if log is not None:
+            log.append(episode, **robot_row(robot, clearance[i]))
+
+    if log is not None:
+        log.end_episode(episode)
+
+    return {"min_clearance": float(np.min(clearance)) if steps else None,
+            "mean_clearance": float(np.mean(clearance)) if steps else None,
+            "collision_step": collision_step,
+            "final_pos": [float(robot.x), float(robot.y)],
+            "steps": steps,
+            "scans": robot.n_scans,
+            "skipped_scans": robot.n_skipped_scans}
+
+
+def main(log_path="evaluate.eplog"):
 
     # Instantiate Map
     src_path_map = "data/two_obs.dat"
     map1 = Map(src_path_map)
 
-    # Instantiate dense lidar for evaluation
-    dense_lidar = LidarSimulator(map1, angles=np.arange(90)*4)
-
     # Instantiate Robot to be evaluated
     safe_robbie = Robot(map1, use_safe=True)
     unsafe_robbie = Robot(map1, use_safe=False)
@@ -37,6 +116,11 @@ def main():
     safe_closest_list = []
     unsafe_closest_list = []
 
+    # Stream both runs to a binary episode log (read with EpisodeLogReader)
+    log = EpisodeLogWriter(log_path, robot_columns(len(safe_robbie.lidar.angles)))
+    safe_episode = log.begin_episode(map=src_path_map, use_safe=True)
+    unsafe_episode = log.begin_episode(map=src_path_map, use_safe=False)
+
     for i in range(100):
 
         plt.cla()
@@ -45,19 +129,22 @@ def main():
         safe_robbie.update()
         unsafe_robbie.update()
 
-        # Evaluation: Get distance to closest obstacle w/ dense lidar
-        safe_closest = distance_to_closest_obstacle(dense_lidar, safe_robbie)
+        # Evaluation: Get distance to closest obstacle from map distance field
+        safe_closest = distance_to_closest_obstacle(safe_robbie)
         safe_closest_list.append(safe_closest)
     
-        unsafe_closest = distance_to_closest_obstacle(dense_lidar, unsafe_robbie)
+        unsafe_closest = distance_to_closest_obstacle(unsafe_robbie)
         unsafe_closest_list.append(unsafe_closest)
-        # TODO: write to text file
+
+        log.append(safe_episode, **robot_row(safe_robbie, safe_closest))
+        log.append(unsafe_episode, **robot_row(unsafe_robbie, unsafe_closest))
 
         # # Visualize
         # map1.visualize_map()
         # safe_robbie.visualize()
         # plt.pause(0.1)
 
+    log.close()
 
     # Visualize history
     map1.visualize_map()
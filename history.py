@@ -0,0 +1,119 @@
+"""history.py
+Columnar history recorder for simulation logs and plotting.
+
+Each column is a preallocated numpy array that grows geometrically, so
+recording a step is a row write rather than a Python list append.
+"""
+
+import numpy as np
+
+
+class HistoryRecorder():
+    """Records named fixed-width columns, one row per recorded step.
+
+    Parameters
+    ----------
+    columns : dict
+        column name -> width. Width 1 gives a (T, ) column, otherwise (T, width).
+    capacity : int
+        initial number of rows. Doubles when full, unless ring is set.
+    ring : bool
+        keep only the last `capacity` rows, overwriting the oldest.
+    decimation : int
+        record every `decimation`-th call to append().
+    dtype : np.dtype
+        storage type, ex. np.float32 to halve memory.
+
+    Columns are read with recorder[name], which returns a view (no copy) of the
+    recorded rows, oldest first. Ring mode writes every row twice into a buffer
+    of twice the capacity, so the last `capacity` rows are always contiguous.
+    """
+
+    def __init__(self, columns, capacity=1024, ring=False, decimation=1, dtype=np.float64):
+        if capacity < 1 or decimation < 1:
+            raise ValueError("capacity and decimation must be positive")
+        self.widths = dict(columns)
+        self.capacity = capacity
+        self.ring = ring
+        self.decimation = decimation
+        self.dtype = np.dtype(dtype)
+        self.n_calls = 0      # calls to append()
+        self.n_recorded = 0   # rows written, including overwritten ones
+        self.steps_col = None
+        self.cols = {}
+        self._allocate(capacity)
+
+    def _allocate(self, rows):
+        """(Re)allocate columns with room for rows, keeping recorded data."""
+        n_buf = 2 * rows if self.ring else rows
+        old_len = len(self)
+        new_cols = {}
+        for name, width in self.widths.items():
+            shape = (n_buf,) if width == 1 else (n_buf, width)
+            new_cols[name] = np.empty(shape, dtype=self.dtype)
+            if old_len:
+                new_cols[name][:old_len] = self[name]
+        new_steps = np.empty(n_buf, dtype=np.int64)
+        if old_len:
+            new_steps[:old_len] = self.steps
+        self.cols = new_cols
+        self.steps_col = new_steps
+        self.capacity = rows
+
+    def append(self, **values):
+        """Record one row if this call is not skipped by decimation.
+        Returns True if the row was recorded."""
+        step = self.n_calls
+        self.n_calls += 1
+        if step % self.decimation:
+            return False
+
+        if self.ring:
+            rows = [self.n_recorded % self.capacity]
+            rows.append(rows[0] + self.capacity)
+        else:
+            if self.n_recorded == self.capacity:
+                self._allocate(2 * self.capacity)
+            rows = [self.n_recorded]
+
+        for row in rows:
+            for name, val in values.items():
+                self.cols[name][row] = val
+            self.steps_col[row] = step
+        self.n_recorded += 1
+        return True
+
+    def _window(self):
+        """Start and end buffer row of the recorded rows, oldest first."""
+        if self.ring and self.n_recorded > self.capacity:
+            start = self.n_recorded % self.capacity
+            return start, start + self.capacity
+        return 0, self.n_recorded
+
+    def __len__(self):
+        return min(self.n_recorded, self.capacity) if self.ring else self.n_recorded
+
+    def __getitem__(self, name):
+        start, end = self._window()
+        return self.cols[name][start:end]
+
+    def __contains__(self, name):
+        return name in self.cols
+
+    @property
+    def steps(self):
+        """append() call index of each recorded row."""
+        start, end = self._window()
+        return self.steps_col[start:end]
+
+    def last(self, name):
+        """Most recently recorded row of a column."""
+        return self[name][-1]
+
+    def clear(self):
+        self.n_calls = 0
+        self.n_recorded = 0
+
+    def nbytes(self):
+        """Memory used by the column buffers."""
+        return sum(col.nbytes for col in self.cols.values()) + self.steps_col.nbytes
@@ -1,12 +1,14 @@
 
 from simulator import Map, LidarSimulator, Robot
+from renderer import GridRenderer
 import numpy as np
 import matplotlib.pyplot as plt
 import math
 import random
 
 
-def main():
+def main(frame_skip=1):
+    """frame_skip : draw every frame_skip-th step only"""
     print("start!!")
 
     # load map
@@ -16,14 +18,14 @@ def main():
     # initialize robot (initializes lidar with map) 
     robbie = Robot(map1)
 
+    # draws map once, then only updates robot, lidar and control artists
+    renderer = GridRenderer(map1, robbie, frame_skip=frame_skip)
+    plt.show(block=False)
+
     for i in range(100):
         print("Time " + str(i))
-        plt.cla()
-        
         robbie.update()
-        map1.visualize_map()
-        robbie.visualize()
-        plt.pause(0.1)
+        renderer.draw()
         
     print("done!!")
 
@@ -0,0 +1,182 @@
+"""profiler.py
+Per-stage wall-time profiling of Robot.update().
+
+StageProfiler times named stages by wrapping callables: call counts, total /
+min / max time, a log2 histogram per stage, and optionally a timeline that
+exports to the Chrome trace format (open in chrome://tracing or
+https://ui.perfetto.dev). Robot(map1, profiler=StageProfiler()) instruments
+its update and the lidar, controller and dynamics calls. Without a profiler
+nothing is wrapped, so the disabled path costs nothing.
+
+`python profiler.py data/two_obs.dat --steps 200 --summary prof.json --trace trace.json`
+"""
+
+import argparse
+import json
+import os
+import time
+
+from simulator import Map, Robot
+
+N_BINS = 64  # histogram bin k holds durations in [2**(k-1), 2**k) ns
+
+
+class StageProfiler():
+    """Collects per-stage timings.
+
+    Parameters
+    ----------
+    timeline : bool
+        also keep one event per call for save_chrome_trace()
+    max_events : int
+        timeline length limit, later events are counted in n_dropped
+    """
+
+    def __init__(self, timeline=True, max_events=100000):
+        self.timeline = timeline
+        self.max_events = max_events
+        self.stats = {}   # stage -> [count, total ns, min ns, max ns, histogram]
+        self.events = []  # (stage, start ns, duration ns)
+        self.n_dropped = 0
+        self.t_start = time.perf_counter_ns()
+        self.patched = []  # (obj, attribute name) set by instrument()
+
+    def _stage_stats(self, stage):
+        if stage not in self.stats:
+            self.stats[stage] = [0, 0, None, 0, [0] * N_BINS]
+        return self.stats[stage]
+
+    def wrap(self, stage, func):
+        """Returns func, timed as stage."""
+        stats = self._stage_stats(stage)
+        clock = time.perf_counter_ns
+
+        def timed(*args, **kwargs):
+            t0 = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                duration = clock() - t0
+                stats[0] += 1
+                stats[1] += duration
+                if stats[2] is None or duration < stats[2]:
+                    stats[2] = duration
+                if duration > stats[3]:
+                    stats[3] = duration
+                stats[4][min(duration.bit_length(), N_BINS - 1)] += 1
+                if self.timeline:
+                    if len(self.events) < self.max_events:
+                        self.events.append((stage, t0, duration))
+                    else:
+                        self.n_dropped += 1
+
+        timed.__wrapped__ = func
+        return timed
+
+    def instrument(self, obj, name, stage=None):
+        """Time calls to obj.name (as stage, default name) by shadowing it
+        with an instance attribute. Undone by detach()."""
+        setattr(obj, name, self.wrap(stage or name, getattr(obj, name)))
+        self.patched.append((obj, name))
+
+    def detach(self):
+        """Remove all wrappers set by instrument()."""
+        for obj, name in reversed(self.patched):
+            delattr(obj, name)
+        self.patched = []
+
+    def reset(self):
+        """Clear all timings, keeping the instrumentation."""
+        for stats in self.stats.values():
+            stats[:] = [0, 0, None, 0, [0] * N_BINS]
+        self.events = []
+        self.n_dropped = 0
+        self.t_start = time.perf_counter_ns()
+
+    def percentile(self, stage, q):
+        """Estimate of the q-th percentile (us) of stage, interpolated
+        linearly within its histogram bin and clipped to min / max."""
+        count, total, t_min, t_max, hist = self.stats[stage]
+        if count == 0:
+            return None
+        target = q / 100 * count
+        seen = 0
+        for k, n in enumerate(hist):
+            if n and seen + n >= target:
+                lo, hi = 2 ** (k - 1) if k else 0, 2 ** k
+                estimate = lo + (target - seen) / n * (hi - lo)
+                return min(max(estimate, t_min), t_max) / 1e3
+            seen += n
+        return t_max / 1e3
+
+    def summary(self):
+        """Per-stage statistics as a JSON serializable dict, times in us."""
+        stages = {}
+        for stage, (count, total, t_min, t_max, hist) in self.stats.items():
+            used = [k for k, n in enumerate(hist) if n]
+            lo, hi = (used[0], used[-1] + 1) if used else (0, 0)
+            stages[stage] = {
+                "count": count,
+                "total_ms": total / 1e6,
+                "mean_us": total / count / 1e3 if count else None,
+                "min_us": t_min / 1e3 if count else None,
+                "max_us": t_max / 1e3 if count else None,
+                "p50_us": self.percentile(stage, 50),
+                "p90_us": self.percentile(stage, 90),
+                "p99_us": self.percentile(stage, 99),
+                "histogram": {"upper_edges_us": [2 ** k / 1e3 for k in range(lo, hi)],
+                              "counts": hist[lo:hi]}}
+        return {"wall_ms": (time.perf_counter_ns() - self.t_start) / 1e6,
+                "dropped_events": self.n_dropped,
+                "stages": stages}
+
+    def save_summary(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def chrome_trace(self):
+        """Timeline as a Chrome trace dict (complete "X" events, us)."""
+        pid = os.getpid()
+        events = [{"name": stage, "cat": stage.split(".")[0], "ph": "X", "pid": pid, "tid": 0,
+                   "ts": (t0 - self.t_start) / 1e3, "dur": duration / 1e3}
+                  for stage, t0, duration in self.events]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save_chrome_trace(self, path):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+    def format_table(self):
+        """Summary as a text table, slowest total first."""
+        lines = ["%-28s %8s %10s %10s %10s %10s" %
+                 ("stage", "calls", "total ms", "mean us", "p50 us", "p99 us")]
+        stages = self.summary()["stages"]
+        for stage, s in sorted(stages.items(), key=lambda item: -item[1]["total_ms"]):
+            if s["count"]:
+                lines.append("%-28s %8d %10.2f %10.1f %10.1f %10.1f" %
+                             (stage, s["count"], s["total_ms"], s["mean_us"],
+                              s["p50_us"], s["p99_us"]))
+        return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Profile Robot.update() stages")
+    parser.add_argument("map", nargs="?", default="data/two_obs.dat", help="map file")
+    parser.add_argument("--steps", type=int, default=200, help="number of Robot.update() calls")
+    parser.add_argument("--summary", help="write the JSON summary here")
+    parser.add_argument("--trace", help="write the Chrome trace here")
+    args = parser.parse_args(argv)
+
+    profiler = StageProfiler()
+    robot = Robot(Map(args.map), profiler=profiler)
+    for i in range(args.steps):
+        robot.update()
+    print(profiler.format_table())
+    if args.summary:
+        profiler.save_summary(args.summary)
+    if args.trace:
+        profiler.save_chrome_trace(args.trace)
+
+
+if __name__ == '__main__':
+    main()
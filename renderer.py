@@ -0,0 +1,138 @@
+"""renderer.py
+Persistent, blitted renderer for the 2D grid simulation.
+
+The map is drawn once and cached as the background. Robot, trajectory,
+lidar and control artists are created once and only have their data
+updated each frame, then blitted over the background. Same content as
+Map.visualize_map() plus Robot.visualize().
+"""
+
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+
+from simulator import DISPSCALE
+
+
+class GridRenderer():
+    """Draws a robot (with its lidar and controller) on its map.
+
+    Parameters
+    ----------
+    map1 : Map
+    robot : Robot or None
+        robot drawn by draw(). Without one, set artist data with set_frame()
+        and show it with blit().
+    frame_skip : int
+        draw only every frame_skip-th call to draw()
+    ax : matplotlib Axes or None
+        axes to draw in, a new figure if None
+    """
+
+    def __init__(self, map1, robot=None, frame_skip=1, ax=None):
+        if frame_skip < 1:
+            raise ValueError("frame_skip must be positive")
+        self.map = map1
+        self.robot = robot
+        self.frame_skip = frame_skip
+        self.n_calls = 0
+        self.n_drawn = 0
+
+        if ax is None:
+            fig, ax = plt.subplots()
+        self.ax = ax
+        self.fig = ax.figure
+        self.canvas = self.fig.canvas
+
+        # Static: map and axes
+        ax.imshow(map1.map, cmap='Greys')
+        ax.axis([0, map1.width, 0, map1.height])
+        ax.set_xlabel("x")
+        ax.set_ylabel("y")
+
+        # Dynamic: drawn only by blitting
+        self.rays = LineCollection([], colors='k', linewidths=0.1, animated=True)
+        self.unsafe_rays = LineCollection([], colors='r', linewidths=0.5, animated=True)
+        ax.add_collection(self.rays)
+        ax.add_collection(self.unsafe_rays)
+        self.hits, = ax.plot([], [], "o", animated=True)
+        self.traj, = ax.plot([], [], ".", animated=True)
+        self.robot_marker, = ax.plot([], [], "*r", animated=True)
+        self.og_line, = ax.plot([], [], 'g', label="Original", animated=True)
+        self.safe_line, = ax.plot([], [], 'r', label="Safe", animated=True)
+        self.final_line, = ax.plot([], [], 'b', label="Final", animated=True)
+        ax.legend()
+        self.artists = [self.rays, self.unsafe_rays, self.hits, self.traj,
+                        self.robot_marker, self.og_line, self.safe_line, self.final_line]
+
+        self.background = None
+        # the cached background is stale after any full redraw (ex. resize)
+        self.canvas.mpl_connect("draw_event", self._on_draw)
+        self.canvas.draw()
+
+    def _on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self._draw_artists()
+
+    def _draw_artists(self):
+        for artist in self.artists:
+            self.ax.draw_artist(artist)
+
+    def update_artists(self):
+        """Set artist data from the current robot, lidar and controller state."""
+        robot = self.robot
+        pos_cont = robot.pos_cont
+        self.set_frame((robot.x, robot.y), robot.hist_x, robot.hist_y,
+                       robot.lidar.sensed_obs, robot.lidar.unsafe_range,
+                       pos_cont.og_control, pos_cont.safe_control,
+                       (pos_cont.u_x, pos_cont.u_y))
+
+    def set_frame(self, pos, traj_x, traj_y, hits, unsafe, og_control, safe_control, control):
+        """Set artist data.
+
+        Parameters
+        ----------
+        pos : (x, y) robot position
+        traj_x, traj_y : trajectory so far
+        hits : (N, 2) np.ndarray or None
+            lidar hit per beam (nothing drawn if None)
+        unsafe : (N, ) unsafe beam mask
+        og_control, safe_control, control : (ux, uy) original, safe and
+            final control
+        """
+        self.robot_marker.set_data([pos[0]], [pos[1]])
+        self.traj.set_data(traj_x, traj_y)
+
+        if hits is not None:
+            self.hits.set_data(hits[:, 0], hits[:, 1])
+            segments = np.empty((len(hits), 2, 2))
+            segments[:, 0] = hits
+            segments[:, 1] = pos
+            self.rays.set_segments(segments)
+            self.unsafe_rays.set_segments(segments[np.asarray(unsafe).astype(bool)])
+
+        for line, (ux, uy) in ((self.og_line, og_control),
+                               (self.safe_line, safe_control),
+                               (self.final_line, control)):
+            line.set_data([pos[0], pos[0] + ux * DISPSCALE],
+                          [pos[1], pos[1] + uy * DISPSCALE])
+
+    def blit(self):
+        """Show the current artist data over the cached background."""
+        self.canvas.restore_region(self.background)
+        self._draw_artists()
+        self.canvas.blit(self.ax.bbox)
+        self.canvas.flush_events()
+
+    def draw(self):
+        """Draw the current frame unless skipped by frame_skip. Returns True
+        if a frame was drawn."""
+        step = self.n_calls
+        self.n_calls += 1
+        if step % self.frame_skip:
+            return False
+
+        self.update_artists()
+        self.blit()
+        self.n_drawn += 1
+        return True
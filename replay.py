@@ -0,0 +1,178 @@
+"""replay.py
+Record-then-replay: simulate headless at full speed, visualize later.
+
+TraceRecorder records a compact per-step trace of a Robot (pose, lidar
+hits, unsafe beam mask and original / safe / final control) and saves it
+with the map as a compressed .npz. TraceViewer renders a saved trace with
+GridRenderer, playing it at any speed or scrubbing with a slider (or the
+left / right keys).
+
+`python replay.py record data/two_obs.dat --out trace.npz --steps 100`
+`python replay.py view trace.npz --speed 2`
+"""
+
+import argparse
+
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.widgets import Slider
+
+from simulator import Map, Robot
+from history import HistoryRecorder
+from renderer import GridRenderer
+
+
+class TraceRecorder():
+    """Records one row per call to record() from a Robot.
+
+    Parameters
+    ----------
+    robot : Robot
+    capacity : int
+        initial number of rows, see HistoryRecorder
+    dtype : np.dtype
+        storage type of the trace
+    """
+
+    def __init__(self, robot, capacity=1024, dtype=np.float32):
+        self.robot = robot
+        n_beams = len(robot.lidar.angles)
+        self.recorder = HistoryRecorder(
+            {"pos": 2, "yaw": 1, "hits": 2 * n_beams, "unsafe": n_beams,
+             "og_control": 2, "safe_control": 2, "control": 2},
+            capacity=capacity, dtype=dtype)
+
+    def __len__(self):
+        return len(self.recorder)
+
+    def record(self):
+        """Record the robot after its last update()."""
+        robot = self.robot
+        lidar = robot.lidar
+        pos_cont = robot.pos_cont
+        hits = lidar.sensed_obs
+        self.recorder.append(pos=(robot.x, robot.y),
+                             yaw=robot.state["theta"][2],
+                             hits=np.nan if hits is None else hits.ravel(),
+                             unsafe=lidar.unsafe_range,
+                             og_control=pos_cont.og_control,
+                             safe_control=pos_cont.safe_control,
+                             control=(pos_cont.u_x, pos_cont.u_y))
+
+    def to_dict(self):
+        """Trace as a dict of arrays, in the format of load_trace()."""
+        trace = {name: np.array(self.recorder[name]) for name in self.recorder.widths}
+        trace["hits"] = trace["hits"].reshape(len(self), -1, 2)
+        trace["unsafe"] = trace["unsafe"].astype(bool)
+        trace["map"] = np.asarray(self.robot.map.map)
+        trace["angles"] = np.asarray(self.robot.lidar.angles)
+        trace["dt"] = np.float64(self.robot.update_dt)
+        return trace
+
+    def save(self, path):
+        np.savez_compressed(path, **self.to_dict())
+
+
+def load_trace(path):
+    """Load a trace saved by TraceRecorder.save() as a dict of arrays."""
+    with np.load(path) as data:
+        trace = {name: data[name] for name in data.files}
+    return trace
+
+
+def record_episode(map1, steps=100, **robot_kwargs):
+    """Run a Robot headless for steps updates and return its TraceRecorder.
+    robot_kwargs are passed on to Robot."""
+    robot = Robot(map1, **robot_kwargs)
+    trace = TraceRecorder(robot, capacity=max(steps, 1))
+    for i in range(steps):
+        robot.update()
+        trace.record()
+    return trace
+
+
+class TraceViewer():
+    """Renders a trace (from load_trace() or TraceRecorder.to_dict()).
+
+    Drag the slider or press left / right to scrub, or call play().
+    """
+
+    def __init__(self, trace):
+        self.trace = trace
+        self.n_steps = len(trace["pos"])
+        if self.n_steps == 0:
+            raise ValueError("Empty trace")
+        self.map = Map(trace["map"])
+
+        self.fig = plt.figure()
+        ax = self.fig.add_axes([0.1, 0.15, 0.8, 0.8])
+        self.slider_ax = self.fig.add_axes([0.15, 0.03, 0.7, 0.03])
+        self.renderer = GridRenderer(self.map, ax=ax)
+        self.slider = Slider(self.slider_ax, "Step", 0, self.n_steps - 1,
+                             valinit=0, valstep=1, valfmt="%d")
+        self.slider.on_changed(lambda val: self.show_frame(int(val)))
+        self.fig.canvas.mpl_connect("key_press_event", self._on_key)
+        self.step = 0
+        self.show_frame(0)
+
+    def _on_key(self, event):
+        if event.key == "right":
+            self.slider.set_val(min(self.step + 1, self.n_steps - 1))
+        elif event.key == "left":
+            self.slider.set_val(max(self.step - 1, 0))
+
+    def show_frame(self, i):
+        """Draw step i of the trace."""
+        trace = self.trace
+        self.step = i
+        self.renderer.set_frame(trace["pos"][i], trace["pos"][:i + 1, 0], trace["pos"][:i + 1, 1],
+                                trace["hits"][i], trace["unsafe"][i], trace["og_control"][i],
+                                trace["safe_control"][i], trace["control"][i])
+        self.renderer.blit()
+
+    def play(self, speed=1.0, start=0, stop=None, frame_skip=1):
+        """Play steps start to stop at speed times real time (as fast as
+        possible if speed is None)."""
+        stop = self.n_steps if stop is None else stop
+        plt.show(block=False)
+        # move the slider without a full redraw per frame
+        self.slider.drawon = False
+        self.slider.eventson = False
+        try:
+            for i in range(start, stop, frame_skip):
+                self.slider.set_val(i)
+                self.show_frame(i)
+                self.fig.draw_artist(self.slider_ax)
+                self.fig.canvas.blit(self.slider_ax.bbox)
+                if speed is not None:
+                    self.fig.canvas.start_event_loop(float(self.trace["dt"]) * frame_skip / speed)
+        finally:
+            self.slider.drawon = True
+            self.slider.eventson = True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    sub = parser.add_subparsers(dest="command", required=True)
+    rec = sub.add_parser("record", help="run headless and save a trace")
+    rec.add_argument("map", help="map file")
+    rec.add_argument("--out", default="trace.npz", help="trace file to write")
+    rec.add_argument("--steps", type=int, default=100, help="number of Robot.update() calls")
+    rec.add_argument("--unsafe", action="store_true", help="run without safe control")
+    view = sub.add_parser("view", help="replay a saved trace")
+    view.add_argument("trace", help="trace file")
+    view.add_argument("--speed", type=float, default=1.0, help="playback speed (x real time)")
+    args = parser.parse_args(argv)
+
+    if args.command == "record":
+        trace = record_episode(Map(args.map), steps=args.steps, use_safe=not args.unsafe)
+        trace.save(args.out)
+        print("Saved " + str(len(trace)) + " steps to " + args.out)
+    else:
+        viewer = TraceViewer(load_trace(args.trace))
+        viewer.play(speed=args.speed)
+        plt.show()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""scheduler.py
+Multi-rate scheduler for simulation components.
+
+Every task runs at its own period, an integer multiple of the base time
+step (normally the dynamics dt). Tasks due on the same tick run in the
+order they were added, ex. sensing, then control, then dynamics.
+"""
+
+from collections import OrderedDict
+
+
+class MultiRateScheduler():
+    """Runs tasks at integer multiples of a base time step.
+
+    Parameters
+    ----------
+    base_dt : float
+        length of one tick (s)
+    """
+
+    def __init__(self, base_dt):
+        if base_dt <= 0:
+            raise ValueError("base_dt must be positive")
+        self.base_dt = base_dt
+        self.n_ticks = 0
+        self.tasks = OrderedDict()  # name -> [ticks per run, func, n_calls]
+
+    @property
+    def time(self):
+        """Simulated time (s) of the next tick."""
+        return self.n_ticks * self.base_dt
+
+    def to_ticks(self, period):
+        """Number of base ticks in period (s). Raises ValueError if period is
+        not a positive multiple of base_dt."""
+        ticks = int(round(period / self.base_dt))
+        if ticks < 1 or abs(ticks * self.base_dt - period) > 1e-9 * max(1., period):
+            raise ValueError("Period " + str(period) + " is not a multiple of base dt " +
+                             str(self.base_dt))
+        return ticks
+
+    def add_task(self, name, period, func):
+        """Run func() every period seconds, starting on the next tick."""
+        self.tasks[name] = [self.to_ticks(period), func, 0]
+
+    def set_period(self, name, period):
+        self.tasks[name][0] = self.to_ticks(period)
+
+    def period(self, name):
+        return self.tasks[name][0] * self.base_dt
+
+    def n_calls(self, name):
+        """Number of times task name has run."""
+        return self.tasks[name][2]
+
+    def tick(self):
+        """Run the tasks due on this tick and advance time by base_dt."""
+        for task in self.tasks.values():
+            if self.n_ticks % task[0] == 0:
+                task[1]()
+                task[2] += 1
+        self.n_ticks += 1
+
+    def run_for(self, duration):
+        """Tick for duration seconds (rounded to whole ticks)."""
+        for i in range(int(round(duration / self.base_dt))):
+            self.tick()
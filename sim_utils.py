@@ -1,5 +1,14 @@
+import math
+
 import numpy as np
 
+try:
+    from scipy.ndimage import distance_transform_edt
+    from scipy.spatial import cKDTree
+except ImportError:  # scipy is optional, fall back to pure numpy
+    distance_transform_edt = None
+    cKDTree = None
+
 def get_rot_matrix(angles):
     [phi, theta, psi] = angles
     cphi = np.cos(phi)
@@ -14,3 +23,1006 @@ def get_rot_matrix(angles):
                             cpsi, cphi * sthe * spsi - sphi * cpsi],
                         [-sthe,       cthe * sphi,                      cthe * cphi]])
     return rot_mat
+
+
+def get_rot_matrices(angles):
+    """Batched get_rot_matrix().
+
+    Parameters
+    ----------
+    angles : (N, 3) np.ndarray
+        roll, pitch, yaw of each body
+
+    Returns
+    -------
+    rot_mat : (N, 3, 3) np.ndarray
+    """
+    phi, theta, psi = angles[:, 0], angles[:, 1], angles[:, 2]
+    cphi = np.cos(phi)
+    sphi = np.sin(phi)
+    cthe = np.cos(theta)
+    sthe = np.sin(theta)
+    cpsi = np.cos(psi)
+    spsi = np.sin(psi)
+
+    rot_mat = np.empty((len(angles), 3, 3))
+    rot_mat[:, 0, 0] = cthe * cpsi
+    rot_mat[:, 0, 1] = sphi * sthe * cpsi - cphi * spsi
+    rot_mat[:, 0, 2] = cphi * sthe * cpsi + sphi * spsi
+    rot_mat[:, 1, 0] = cthe * spsi
+    rot_mat[:, 1, 1] = sphi * sthe * spsi + cphi * cpsi
+    rot_mat[:, 1, 2] = cphi * sthe * spsi - sphi * cpsi
+    rot_mat[:, 2, 0] = -sthe
+    rot_mat[:, 2, 1] = cthe * sphi
+    rot_mat[:, 2, 2] = cthe * cphi
+    return rot_mat
+
+
+class PackedOccupancy():
+    """Boolean occupancy grid packed 8 cells per byte along x.
+
+    Indexed like a boolean (H, W) array with integer arrays: grid[ys, xs].
+    Uses 1 bit per cell, 64x less than a float64 grid.
+    """
+
+    def __init__(self, occupied):
+        occupied = np.asarray(occupied, dtype=bool)
+        self.shape = occupied.shape
+        self.bits = np.packbits(occupied, axis=1)
+
+    def __getitem__(self, idx):
+        ys, xs = idx
+        xs = np.asarray(xs)
+        return ((self.bits[ys, xs >> 3] >> (7 - (xs & 7))) & 1).astype(bool)
+
+    def unpack(self):
+        """Dense (H, W) boolean copy."""
+        return np.unpackbits(self.bits, axis=1, count=self.shape[1]).astype(bool)
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+
+class QuantizedField():
+    """Non-negative field (ex. a distance field) stored as uint16 multiples
+    of step, 2 bytes per cell.
+
+    Values are rounded down, so decoded values are lower bounds of the true
+    ones, exact at 0. step is a power of 2, so that rounding is exact. Values
+    from 65535 * step up (inf included) saturate there. Indexed like a
+    float (H, W) array: field[ys, xs] returns float32 values.
+    """
+    MAX_CODE = 65535
+
+    def __init__(self, values, step=1 / 16.):
+        values = np.asarray(values, dtype=float)
+        self.shape = values.shape
+        self.step = step
+        self.codes = np.minimum(np.floor(values / step), self.MAX_CODE).astype(np.uint16)
+
+    def __getitem__(self, idx):
+        return self.codes[idx] * np.float32(self.step)
+
+    def decode(self):
+        """Dense (H, W) float32 copy."""
+        return self.codes * np.float32(self.step)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+
+class OccupancyPyramid():
+    """Max-pooled occupancy pyramid, like a quadtree over the grid.
+
+    levels[l][by, bx] is True if any cell of the 2^l x 2^l block (bx, by) is
+    occupied. levels[0] is the occupancy grid itself (not copied), the top
+    level is a single block covering the whole map. Coarser levels are
+    packed too if the grid is a PackedOccupancy.
+    """
+
+    def __init__(self, occupied):
+        self.shape = occupied.shape
+        self.levels = [occupied]
+        packed = isinstance(occupied, PackedOccupancy)
+        prev = occupied.unpack() if packed else np.asarray(occupied, dtype=bool)
+        while len(self.levels) == 1 or max(prev.shape) > 1:
+            h, w = prev.shape
+            padded = np.zeros((h + h % 2, w + w % 2), dtype=bool)
+            padded[:h, :w] = prev
+            prev = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2).any(axis=(1, 3))
+            self.levels.append(PackedOccupancy(prev) if packed else prev)
+
+    def empty_level(self, xs, ys):
+        """Coarsest level whose block around each cell (x, y) is empty, -1 for
+        occupied cells. Cells must lie inside the grid."""
+        xs = np.asarray(xs, dtype=np.int64)
+        ys = np.asarray(ys, dtype=np.int64)
+        # Blocks are nested, so the number of empty levels gives the coarsest
+        n_empty = np.zeros(xs.shape, dtype=np.int64)
+        for level, grid in enumerate(self.levels):
+            n_empty += ~np.asarray(grid[ys >> level, xs >> level], dtype=bool)
+        return n_empty - 1
+
+    def any_occupied(self, x0, y0, x1, y1):
+        """True if any cell in the rectangle [x0, x1] x [y0, y1] (inclusive,
+        clipped to the grid) is occupied."""
+        x0, y0 = max(int(x0), 0), max(int(y0), 0)
+        x1, y1 = min(int(x1), self.shape[1] - 1), min(int(y1), self.shape[0] - 1)
+        if x0 > x1 or y0 > y1:
+            return False
+        # Descend from the top, only into occupied blocks touching the rectangle
+        blocks = [(len(self.levels) - 1, 0, 0)]
+        while blocks:
+            level, bx, by = blocks.pop()
+            if not self.levels[level][by, bx]:
+                continue
+            size = 1 << level
+            bx0, by0 = bx * size, by * size
+            if x0 <= bx0 and bx0 + size - 1 <= x1 and y0 <= by0 and by0 + size - 1 <= y1:
+                return True
+            half = size >> 1
+            for cx in (bx0, bx0 + half):
+                for cy in (by0, by0 + half):
+                    if cx <= x1 and cx + half - 1 >= x0 and cy <= y1 and cy + half - 1 >= y0:
+                        blocks.append((level - 1, cx // half, cy // half))
+        return False
+
+
+def _lower_envelope_rows(f):
+    """Exact 1D squared distance transform of every row of f (Felzenszwalb &
+    Huttenlocher): d(y, x) = min_k f(y, k) + (x - k)^2, with inf for cells
+    that never contribute. Linear in the row length; the envelope of all
+    rows is built together, one column at a time.
+
+    Parameters
+    ----------
+    f : (H, W) np.ndarray
+        squared distances, inf where unknown
+
+    Returns
+    -------
+    d : (H, W) np.ndarray
+    """
+    height, width = f.shape
+    rows = np.arange(height)
+    v = np.zeros((height, width), dtype=np.int64)      # parabola vertices
+    z = np.full((height, width + 1), np.inf)           # envelope boundaries
+    k = np.full(height, -1, dtype=np.int64)            # last parabola, -1 if none
+    for q in range(width):
+        fq = f[:, q]
+        active = np.isfinite(fq)
+        new = np.nonzero(active & (k < 0))[0]
+        idx = np.nonzero(active & (k >= 0))[0]
+        if len(idx):
+            # pop parabolas hidden by the one at q
+            kk = k[idx]
+            while True:
+                vk = v[idx, kk]
+                s = ((fq[idx] + q * q) - (f[idx, vk] + vk * vk)) / (2. * (q - vk))
+                pop = s <= z[idx, kk]
+                if not pop.any():
+                    break
+                kk[pop] -= 1
+            kk += 1
+            k[idx] = kk
+            v[idx, kk] = q
+            z[idx, kk] = s
+            z[idx, kk + 1] = np.inf
+        if len(new):
+            k[new] = 0
+            v[new, 0] = q
+            z[new, 0] = -np.inf
+            z[new, 1] = np.inf
+
+    started = k >= 0
+    d = np.full(f.shape, np.inf)
+    if not started.any():
+        return d
+    idx = rows[started]
+    kk = np.zeros(len(idx), dtype=np.int64)
+    for q in range(width):
+        while True:
+            step = z[idx, kk + 1] < q
+            if not step.any():
+                break
+            kk[step] += 1
+        vk = v[idx, kk]
+        d[idx, q] = (q - vk)**2 + f[idx, vk]
+    return d
+
+
+def euclidean_distance_transform(occupied, dtype=np.float64):
+    """Compute distance from every cell to the nearest occupied cell (in cells).
+    Uses scipy if installed, otherwise an exact separable numpy version
+    (column sweeps, then a linear-time lower envelope along rows).
+
+    Parameters
+    ----------
+    occupied : (H, W) np.ndarray or PackedOccupancy
+        boolean occupancy grid, indexed [y, x]
+    dtype : np.dtype
+        type of the returned distances
+
+    Returns
+    -------
+    dist : (H, W) np.ndarray
+        Euclidean distance between cell centers, 0 on occupied cells and
+        inf everywhere if there are no occupied cells
+    """
+    if isinstance(occupied, PackedOccupancy):
+        occupied = occupied.unpack()
+    occupied = np.asarray(occupied, dtype=bool)
+    height, width = occupied.shape
+    if not occupied.any():
+        return np.full(occupied.shape, np.inf, dtype=dtype)
+    if distance_transform_edt is not None:
+        return distance_transform_edt(~occupied).astype(dtype, copy=False)
+
+    # 1D distance along each column (forward then backward sweep)
+    col_dist = np.where(occupied, 0., np.inf)
+    for y in range(1, height):
+        col_dist[y] = np.minimum(col_dist[y], col_dist[y-1] + 1)
+    for y in range(height - 2, -1, -1):
+        col_dist[y] = np.minimum(col_dist[y], col_dist[y+1] + 1)
+
+    # Combine along rows: d^2(y, x) = min_k col_dist(y, k)^2 + (x - k)^2
+    dist_sq = _lower_envelope_rows(col_dist**2)
+    return np.sqrt(dist_sq).astype(dtype, copy=False)
+
+
+def bilinear_interpolate(grid, xs, ys):
+    """Sample grid (indexed [y, x], values at integer cell coordinates) at
+    continuous positions. Positions outside the grid are clamped to its edge.
+
+    Parameters
+    ----------
+    grid : (H, W) np.ndarray
+    xs, ys : (N, ) np.ndarray
+        query positions
+
+    Returns
+    -------
+    values : (N, ) np.ndarray
+        inf wherever one of the four surrounding values is inf (e.g. the
+        distance field of a map without obstacles)
+    """
+    height, width = grid.shape
+    xs = np.clip(np.asarray(xs, dtype=float), 0, width - 1)
+    ys = np.clip(np.asarray(ys, dtype=float), 0, height - 1)
+    x0 = np.minimum(np.floor(xs).astype(np.int64), max(width - 2, 0))
+    y0 = np.minimum(np.floor(ys).astype(np.int64), max(height - 2, 0))
+    x1 = np.minimum(x0 + 1, width - 1)
+    y1 = np.minimum(y0 + 1, height - 1)
+    fx = xs - x0
+    fy = ys - y0
+
+    v00, v01 = grid[y0, x0], grid[y0, x1]
+    v10, v11 = grid[y1, x0], grid[y1, x1]
+    # inf * 0 weights would give nan, so interpolate finite values only
+    infinite = ~(np.isfinite(v00) & np.isfinite(v01) & np.isfinite(v10) & np.isfinite(v11))
+    if np.any(infinite):
+        v00, v01, v10, v11 = (np.where(infinite, 0., v) for v in (v00, v01, v10, v11))
+    top = v00 * (1 - fx) + v01 * fx
+    bottom = v10 * (1 - fx) + v11 * fx
+    values = top * (1 - fy) + bottom * fy
+    if np.any(infinite):
+        values = np.where(infinite, np.inf, values)
+    return values
+
+
+def _bresenham_line_params(start, end_points):
+    """Per-line constants for the closed form of bresenham.bresenham()."""
+    x0, y0 = int(start[0]), int(start[1])
+    end_points = np.asarray(end_points, dtype=np.int64).reshape(-1, 2)
+    dx = end_points[:, 0] - x0
+    dy = end_points[:, 1] - y0
+    xsign = np.where(dx > 0, 1, -1)
+    ysign = np.where(dy > 0, 1, -1)
+    dx = np.abs(dx)
+    dy = np.abs(dy)
+
+    # Same branch as bresenham(): x is the major axis only if dx > dy
+    steep = dx <= dy
+    major = np.where(steep, dy, dx)
+    minor = np.where(steep, dx, dy)
+    return x0, y0, xsign, ysign, steep, major, minor
+
+
+def _bresenham_line_cells(line, idx, steps):
+    """Cells (x, y) at major-axis steps of lines idx. steps broadcasts
+    against idx[:, None]."""
+    x0, y0, xsign, ysign, steep, major, minor = line
+    # Minor-axis offset of step i is floor((2*minor*i + major) / (2*major))
+    minor_off = ((2 * minor[idx, None] * steps + major[idx, None]) //
+                 (2 * np.maximum(major[idx, None], 1)))
+    major_off = np.broadcast_to(steps, minor_off.shape)
+    s = steep[idx, None]
+    px = x0 + np.where(s, minor_off, major_off) * xsign[idx, None]
+    py = y0 + np.where(s, major_off, minor_off) * ysign[idx, None]
+    return px, py
+
+
+def bresenham_raycast(occupied, start, end_points, chunk_size=64):
+    """Trace Bresenham lines from one start cell to many end cells at once and
+    find the first occupied cell along each line.
+
+    Walks every line in lockstep, `chunk_size` cells at a time, and stops as
+    soon as all lines have hit an obstacle or run out of cells. Line cells are
+    computed in closed form, so they match `bresenham.bresenham` exactly.
+
+    Parameters
+    ----------
+    occupied : (H, W) np.ndarray or PackedOccupancy
+        boolean occupancy grid, indexed [y, x]
+    start : (2, ) int
+        start cell (x, y), may lie outside the grid
+    end_points : (N, 2) int np.ndarray
+        end cell (x, y) of each line
+    chunk_size : int
+        number of cells per line checked per iteration
+
+    Returns
+    -------
+    hit_cells : (N, 2) int np.ndarray
+        first occupied cell (x, y) of each line, -1 where there is none
+    hit : (N, ) bool np.ndarray
+        True where the line hits an occupied cell
+    in_bounds : (N, ) bool np.ndarray
+        True where at least one cell of the line lies inside the grid
+    """
+    height, width = occupied.shape
+    line = _bresenham_line_params(start, end_points)
+    n_cells = line[5] + 1
+
+    n_lines = len(n_cells)
+    hit_step = np.full(n_lines, -1, dtype=np.int64)
+    in_bounds = np.zeros(n_lines, dtype=bool)
+    active = np.arange(n_lines)
+    max_cells = int(n_cells.max()) if n_lines > 0 else 0
+
+    for first_step in range(0, max_cells, chunk_size):
+        steps = np.arange(first_step, min(first_step + chunk_size, max_cells))
+        px, py = _bresenham_line_cells(line, active, steps[None, :])
+        valid = ((steps[None, :] < n_cells[active, None]) &
+                 (px >= 0) & (px < width) & (py >= 0) & (py < height))
+        occ = np.zeros(valid.shape, dtype=bool)
+        occ[valid] = occupied[py[valid], px[valid]]
+        in_bounds[active] |= valid.any(axis=1)
+
+        has_hit = occ.any(axis=1)
+        hit_step[active[has_hit]] = first_step + occ[has_hit].argmax(axis=1)
+
+        # Early exit: drop lines that hit or have no cells left
+        finished = has_hit | (n_cells[active] <= steps[-1] + 1)
+        active = active[~finished]
+        if active.size == 0:
+            break
+
+    return _cells_at_steps(line, hit_step) + (in_bounds,)
+
+
+def _cells_at_steps(line, hit_step):
+    """Turn per-line hit steps (-1 for no hit) into hit cells and hit mask."""
+    hit = hit_step >= 0
+    hit_cells = np.full((len(hit_step), 2), -1, dtype=np.int64)
+    if hit.any():
+        idx = np.flatnonzero(hit)
+        px, py = _bresenham_line_cells(line, idx, hit_step[idx, None])
+        hit_cells[idx, 0] = px[:, 0]
+        hit_cells[idx, 1] = py[:, 0]
+    return hit_cells, hit
+
+
+def sphere_trace_raycast(dist_field, start, end_points):
+    """Same as bresenham_raycast(), but jumps along each line by the distance
+    to the closest obstacle instead of visiting every cell.
+
+    From a free cell at distance d to the closest obstacle, the next
+    ceil((d - 1) / l) - 1 cells of the line are free too, where l is the line
+    length per major-axis step (the - 1 covers rounding of the minor axis).
+    Hits are therefore identical to bresenham_raycast().
+
+    Parameters
+    ----------
+    dist_field : (H, W) np.ndarray
+        distance (in cells) to the closest occupied cell, 0 on occupied cells
+    start : (2, ) int
+        start cell (x, y), may lie outside the grid
+    end_points : (N, 2) int np.ndarray
+        end cell (x, y) of each line
+
+    Returns
+    -------
+    hit_cells, hit, in_bounds
+        see bresenham_raycast()
+    """
+    height, width = dist_field.shape
+    line = _bresenham_line_params(start, end_points)
+    major, minor = line[5], line[6]
+    n_cells = major + 1
+    step_len = np.sqrt(1 + (minor / np.maximum(major, 1))**2)
+
+    n_lines = len(n_cells)
+    step = np.zeros(n_lines, dtype=np.int64)
+    hit_step = np.full(n_lines, -1, dtype=np.int64)
+    in_bounds = np.zeros(n_lines, dtype=bool)
+    active = np.arange(n_lines)
+
+    while active.size > 0:
+        px, py = _bresenham_line_cells(line, active, step[active, None])
+        px, py = px[:, 0], py[:, 0]
+        inside = (px >= 0) & (px < width) & (py >= 0) & (py < height)
+        in_bounds[active] |= inside
+
+        cell_dist = np.zeros(len(active))
+        cell_dist[inside] = dist_field[py[inside], px[inside]]
+        is_hit = inside & (cell_dist == 0)
+        hit_step[active[is_hit]] = step[active[is_hit]]
+
+        # Outside the grid there is no distance information, take one cell
+        # (clamped to the end of the line, the field is inf on an empty map)
+        jump = np.maximum(np.ceil((cell_dist - 1) / step_len[active]), 1)
+        jump = np.minimum(jump, n_cells[active] - step[active])
+        step[active] += jump.astype(np.int64)
+
+        # A line that left the grid cannot come back
+        left_grid = ~inside & in_bounds[active]
+        active = active[~is_hit & ~left_grid & (step[active] < n_cells[active])]
+
+    return _cells_at_steps(line, hit_step) + (in_bounds,)
+
+
+def pyramid_raycast(pyramid, start, end_points):
+    """Same as bresenham_raycast(), but skips whole empty blocks of an
+    OccupancyPyramid instead of visiting every cell.
+
+    From a free cell, the line jumps straight to the first of its cells that
+    lies outside the coarsest empty block around that cell. Both exits (along
+    the major and the minor axis) follow from the closed form of the line, so
+    hits are identical to bresenham_raycast(). Per-line cost grows with the
+    number of occupied regions the line passes near, not with its length.
+
+    Parameters
+    ----------
+    pyramid : OccupancyPyramid
+    start : (2, ) int
+        start cell (x, y), may lie outside the grid
+    end_points : (N, 2) int np.ndarray
+        end cell (x, y) of each line
+
+    Returns
+    -------
+    hit_cells, hit, in_bounds
+        see bresenham_raycast()
+    """
+    height, width = pyramid.shape
+    line = _bresenham_line_params(start, end_points)
+    x0, y0, xsign, ysign, steep, major, minor = line
+    n_cells = major + 1
+    major_start = np.where(steep, y0, x0)
+    major_sign = np.where(steep, ysign, xsign)
+    minor_start = np.where(steep, x0, y0)
+    minor_sign = np.where(steep, xsign, ysign)
+
+    n_lines = len(n_cells)
+    step = np.zeros(n_lines, dtype=np.int64)
+    hit_step = np.full(n_lines, -1, dtype=np.int64)
+    in_bounds = np.zeros(n_lines, dtype=bool)
+    active = np.arange(n_lines)
+
+    while active.size > 0:
+        px, py = _bresenham_line_cells(line, active, step[active, None])
+        px, py = px[:, 0], py[:, 0]
+        inside = (px >= 0) & (px < width) & (py >= 0) & (py < height)
+        in_bounds[active] |= inside
+
+        level = np.zeros(len(active), dtype=np.int64)
+        level[inside] = pyramid.empty_level(px[inside], py[inside])
+        is_hit = inside & (level < 0)
+        hit_step[active[is_hit]] = step[active[is_hit]]
+
+        # Block bounds along the major and minor axis, outside the grid a
+        # block of one cell
+        level = np.maximum(level, 0)
+        s = steep[active]
+        cur_major = np.where(s, py, px)
+        cur_minor = np.where(s, px, py)
+        block_lo_major = (cur_major >> level) << level
+        block_lo_minor = (cur_minor >> level) << level
+        block_hi_major = block_lo_major + (1 << level) - 1
+        block_hi_minor = block_lo_minor + (1 << level) - 1
+
+        # Steps until the major coordinate leaves the block
+        exit_major = step[active] + 1 + np.where(
+            major_sign[active] > 0, block_hi_major - cur_major, cur_major - block_lo_major)
+        # First step whose minor offset reaches the block edge:
+        # floor((2*minor*i + major) / (2*major)) >= off
+        off = np.where(minor_sign[active] > 0,
+                       block_hi_minor - minor_start[active] + 1,
+                       minor_start[active] - block_lo_minor + 1)
+        mn = minor[active]
+        mj = major[active]
+        num = 2 * mj * off - mj
+        exit_minor = np.where(mn > 0, -(-num // np.maximum(2 * mn, 1)), n_cells[active])
+        step[active] = np.maximum(np.minimum(exit_major, exit_minor), step[active] + 1)
+
+        # A line that left the grid cannot come back
+        left_grid = ~inside & in_bounds[active]
+        active = active[~is_hit & ~left_grid & (step[active] < n_cells[active])]
+
+    return _cells_at_steps(line, hit_step) + (in_bounds,)
+
+
+def grid_to_rects(occupied):
+    """Cover occupied cells with axis-aligned rectangles, by finding runs of
+    occupied cells in every row and merging runs with the same x extent in
+    consecutive rows.
+
+    Parameters
+    ----------
+    occupied : (H, W) np.ndarray or PackedOccupancy
+        boolean occupancy grid, indexed [y, x]
+
+    Returns
+    -------
+    rects : (R, 4) int np.ndarray
+        x0, y0, x1, y1 of each rectangle, in (inclusive) cells
+    """
+    if isinstance(occupied, PackedOccupancy):
+        occupied = occupied.unpack()
+    occupied = np.asarray(occupied, dtype=bool)
+    height, width = occupied.shape
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = occupied
+    edges = np.diff(padded, axis=1)
+
+    rects = []
+    open_rects = {}  # (x0, x1) -> y0 of rectangle still growing
+    for y in range(height + 1):
+        runs = set()
+        if y < height:
+            starts = np.flatnonzero(edges[y] == 1)
+            ends = np.flatnonzero(edges[y] == -1) - 1
+            runs = set(zip(starts.tolist(), ends.tolist()))
+        for run in list(open_rects):
+            if run not in runs:
+                rects.append((run[0], open_rects.pop(run), run[1], y - 1))
+        for run in runs:
+            open_rects.setdefault(run, y)
+    return np.array(rects, dtype=np.int64).reshape(-1, 4)
+
+
+def rects_to_segments(rects):
+    """Boundary segments of cell rectangles. Cell (x, y) covers the square
+    [x - 0.5, x + 0.5] x [y - 0.5, y + 0.5].
+
+    Parameters
+    ----------
+    rects : (R, 4) np.ndarray
+        x0, y0, x1, y1 in (inclusive) cells
+
+    Returns
+    -------
+    segments : (4R, 4) np.ndarray
+        ax, ay, bx, by of each segment
+    """
+    rects = np.asarray(rects, dtype=float).reshape(-1, 4)
+    x0 = rects[:, 0] - 0.5
+    y0 = rects[:, 1] - 0.5
+    x1 = rects[:, 2] + 0.5
+    y1 = rects[:, 3] + 0.5
+    return np.concatenate([
+        np.column_stack((x0, y0, x1, y0)),
+        np.column_stack((x1, y0, x1, y1)),
+        np.column_stack((x1, y1, x0, y1)),
+        np.column_stack((x0, y1, x0, y0))])
+
+
+def split_crossing_segments(segments, chunk_size=256, eps=1e-9):
+    """Split segments where they cross, or where one ends on the interior of
+    another, so that segments meet at most at their endpoints (as
+    VisibilityPolygon requires). Both pieces at a crossing share the exact
+    same endpoint. Collinear overlaps are left as they are, since they
+    never change which segment is closest.
+
+    Compares all pairs with overlapping bounding boxes, O(E^2) in the worst
+    case: meant to be done once per map.
+
+    Parameters
+    ----------
+    segments : (E, 4) np.ndarray
+        ax, ay, bx, by of each segment
+    chunk_size : int
+        segments compared against all others at a time
+    eps : float
+        tolerance on the position along a segment (fraction of its length)
+
+    Returns
+    -------
+    pieces : (M, 4) np.ndarray
+        ax, ay, bx, by, in the order of the input segments
+    """
+    segs = np.asarray(segments, dtype=float).reshape(-1, 4)
+    n = len(segs)
+    start = segs[:, :2]
+    vec = segs[:, 2:] - start
+    lo = np.minimum(segs[:, :2], segs[:, 2:])
+    hi = np.maximum(segs[:, :2], segs[:, 2:])
+
+    split_seg, split_t, split_pt = [], [], []
+    for i0 in range(0, n, chunk_size):
+        i1 = min(i0 + chunk_size, n)
+        boxes = np.all((lo[i0:i1, None] <= hi[None]) & (lo[None] <= hi[i0:i1, None]), axis=2)
+        ii, jj = np.nonzero(boxes)
+        ii += i0
+        pair = jj > ii
+        ii, jj = ii[pair], jj[pair]
+
+        d = start[jj] - start[ii]
+        denom = vec[ii, 0] * vec[jj, 1] - vec[ii, 1] * vec[jj, 0]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = (d[:, 0] * vec[jj, 1] - d[:, 1] * vec[jj, 0]) / denom
+            u = (d[:, 0] * vec[ii, 1] - d[:, 1] * vec[ii, 0]) / denom
+        meet = ((denom != 0) & (t >= -eps) & (t <= 1 + eps) & (u >= -eps) & (u <= 1 + eps))
+        ii, jj, t, u = ii[meet], jj[meet], t[meet], u[meet]
+
+        # One point per crossing, snapped to an endpoint when it is one
+        pt = start[ii] + t[:, None] * vec[ii]
+        pt = np.where((u <= eps)[:, None], start[jj], pt)
+        pt = np.where((u >= 1 - eps)[:, None], segs[jj, 2:], pt)
+        pt = np.where((t <= eps)[:, None], start[ii], pt)
+        pt = np.where((t >= 1 - eps)[:, None], segs[ii, 2:], pt)
+        for seg, param in ((ii, t), (jj, u)):
+            inner = (param > eps) & (param < 1 - eps)
+            split_seg.append(seg[inner])
+            split_t.append(param[inner])
+            split_pt.append(pt[inner])
+
+    # Endpoints and split points of every segment, ordered along it
+    seg_ids = np.concatenate([np.arange(n), np.arange(n)] + split_seg)
+    params = np.concatenate([np.zeros(n), np.ones(n)] + split_t)
+    points = np.concatenate([segs[:, :2], segs[:, 2:]] + split_pt)
+    order = np.lexsort((params, seg_ids))
+    seg_ids, params, points = seg_ids[order], params[order], points[order]
+
+    piece = (seg_ids[1:] == seg_ids[:-1]) & (params[1:] - params[:-1] > eps)
+    return np.column_stack((points[:-1][piece], points[1:][piece]))
+
+
+def ray_segment_raycast(segments, origin, cos_beam, sin_beam, chunk_size=256):
+    """Distance along each ray to the closest segment, intersecting all rays
+    with all segments at once.
+
+    Parameters
+    ----------
+    segments : (E, 4) np.ndarray
+        ax, ay, bx, by of each segment
+    origin : (2, ) float
+        ray origin (x, y)
+    cos_beam, sin_beam : (N, ) np.ndarray
+        ray directions
+    chunk_size : int
+        number of rays intersected per batch, bounds memory to chunk x E
+
+    Returns
+    -------
+    t : (N, ) np.ndarray
+        distance to the closest segment, inf where the ray hits none
+    seg_idx : (N, ) int np.ndarray
+        index of the closest segment, -1 where the ray hits none
+    """
+    segments = np.asarray(segments, dtype=float).reshape(-1, 4)
+    n_rays = len(cos_beam)
+    t_min = np.full(n_rays, np.inf)
+    seg_idx = np.full(n_rays, -1, dtype=np.int64)
+    if len(segments) == 0:
+        return t_min, seg_idx
+
+    ex = segments[:, 2] - segments[:, 0]
+    ey = segments[:, 3] - segments[:, 1]
+    wx = segments[:, 0] - origin[0]
+    wy = segments[:, 1] - origin[1]
+    w_cross_e = wx * ey - wy * ex
+
+    for i0 in range(0, n_rays, chunk_size):
+        c = cos_beam[i0:i0+chunk_size, None]
+        s = sin_beam[i0:i0+chunk_size, None]
+        # Solve origin + t * d = a + u * e
+        denom = c * ey - s * ex
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = w_cross_e / denom
+            u = (wx * s - wy * c) / denom
+        valid = (denom != 0) & (t >= 0) & (u >= 0) & (u <= 1)
+        t = np.where(valid, t, np.inf)
+        best = np.argmin(t, axis=1)
+        t_best = t[np.arange(len(best)), best]
+        t_min[i0:i0+chunk_size] = t_best
+        seg_idx[i0:i0+chunk_size] = np.where(np.isfinite(t_best), best, -1)
+    return t_min, seg_idx
+
+
+def _ray_segment_distance(segments, origin, cos_beam, sin_beam):
+    """Distance along rays (N, ) to the lines through matching segments (N, 4)."""
+    ex = segments[..., 2] - segments[..., 0]
+    ey = segments[..., 3] - segments[..., 1]
+    wx = segments[..., 0] - origin[0]
+    wy = segments[..., 1] - origin[1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (wx * ey - wy * ex) / (cos_beam * ey - sin_beam * ex)
+
+
+class VisibilityPolygon():
+    """Region visible from an origin among obstacle segments, from an angular
+    sweep over the segment endpoints.
+
+    The full turn is split into angular intervals; interval k starts at
+    starts[k] and sees segment seg_ids[k] (-1 for nothing). Ranges at any
+    number of angles are then one lookup and one ray-line intersection each.
+
+    Segments must not cross each other (touching at endpoints is fine);
+    split them with split_crossing_segments() first otherwise. Crossings are
+    not checked here, the result is silently wrong with them.
+
+    The sweep sorts 2E events and keeps the segments under the sweep line in
+    a plain list, ordered by distance: O(E log E) comparisons, but inserts
+    and removals move list items, O(E^2) in the worst case (when most
+    segments overlap in angle). These moves are cheap memmoves, in practice
+    the sort and the comparisons dominate.
+
+    Parameters
+    ----------
+    segments : (E, 4) np.ndarray
+        ax, ay, bx, by of each segment
+    origin : (2, ) float
+        viewpoint (x, y)
+    """
+
+    def __init__(self, segments, origin):
+        self.segments = np.asarray(segments, dtype=float).reshape(-1, 4)
+        self.origin = (float(origin[0]), float(origin[1]))
+        self.starts, self.seg_ids = self._sweep()
+
+    def _sweep(self):
+        two_pi = 2 * np.pi
+        ox, oy = self.origin
+        segs = self.segments
+        ang_a = np.arctan2(segs[:, 1] - oy, segs[:, 0] - ox) % two_pi
+        ang_b = np.arctan2(segs[:, 3] - oy, segs[:, 2] - ox) % two_pi
+        cross = ((segs[:, 0] - ox) * (segs[:, 3] - oy) -
+                 (segs[:, 1] - oy) * (segs[:, 2] - ox))
+        # Counter-clockwise angular interval of every segment. Segments seen
+        # edge-on (cross == 0) block no interval.
+        start = np.where(cross > 0, ang_a, ang_b)
+        span = np.where(cross > 0, ang_b - ang_a, ang_a - ang_b) % two_pi
+        keep = np.flatnonzero(cross != 0)
+
+        # Pieces (seg, start, end) with 0 <= start < end <= 2 pi, splitting
+        # intervals that wrap past angle 0
+        pieces = []
+        start, span = start.tolist(), span.tolist()
+        for i in keep.tolist():
+            s, e = start[i], start[i] + span[i]
+            if e > two_pi:
+                pieces.append((i, s, two_pi))
+                pieces.append((i, 0., e - two_pi))
+            else:
+                pieces.append((i, s, e))
+
+        # Events sorted by angle, ends before starts at the same angle
+        events = sorted([(p[1], 1, j) for j, p in enumerate(pieces)] +
+                        [(p[2], 0, j) for j, p in enumerate(pieces)])
+
+        # Plain floats, the sweep compares one pair at a time
+        seg_list = (segs - (ox, oy, ox, oy)).tolist()
+
+        def dist(j, angle):
+            ax, ay, bx, by = seg_list[pieces[j][0]]
+            ex, ey = bx - ax, by - ay
+            return (ax * ey - ay * ex) / (math.cos(angle) * ey - math.sin(angle) * ex)
+
+        def in_front(j, other):
+            # Non-crossing segments keep their order over their common
+            # interval, so compare in its middle (avoids shared endpoints)
+            mid = 0.5 * (max(pieces[j][1], pieces[other][1]) +
+                         min(pieces[j][2], pieces[other][2]))
+            return dist(j, mid) < dist(other, mid)
+
+        active = []  # active pieces, closest first
+        starts = [0.]
+        seg_ids = [-1]
+        n_events = len(events)
+        i = 0
+        while i < n_events:
+            angle = events[i][0]
+            while i < n_events and events[i][0] == angle:
+                _, is_start, j = events[i]
+                if is_start:
+                    lo, hi = 0, len(active)
+                    while lo < hi:
+                        mid = (lo + hi) // 2
+                        if in_front(j, active[mid]):
+                            hi = mid
+                        else:
+                            lo = mid + 1
+                    active.insert(lo, j)
+                else:
+                    active.remove(j)
+                i += 1
+            closest = pieces[active[0]][0] if active else -1
+            if angle < two_pi and closest != seg_ids[-1]:
+                if starts[-1] == angle:
+                    seg_ids[-1] = closest
+                else:
+                    starts.append(angle)
+                    seg_ids.append(closest)
+        return np.array(starts), np.array(seg_ids, dtype=np.int64)
+
+    def ranges(self, angles):
+        """Distance to the visible obstacle at every angle (rad), inf if none."""
+        angles = np.asarray(angles, dtype=float) % (2 * np.pi)
+        ids = self.seg_ids[np.searchsorted(self.starts, angles, side="right") - 1]
+        t = np.full(angles.shape, np.inf)
+        seen = ids >= 0
+        t[seen] = _ray_segment_distance(self.segments[ids[seen]], self.origin,
+                                        np.cos(angles[seen]), np.sin(angles[seen]))
+        return t
+
+    def closest_point(self):
+        """Exact distance and angle (rad) of the closest visible obstacle point,
+        (inf, 0) if nothing is visible."""
+        ends = np.append(self.starts[1:], 2 * np.pi)
+        seen = np.flatnonzero(self.seg_ids >= 0)
+        if seen.size == 0:
+            return np.inf, 0.
+        segs = self.segments[self.seg_ids[seen]]
+        lo, hi = self.starts[seen], ends[seen]
+
+        # Closest point of each visible piece: foot of the perpendicular from
+        # the origin if it lies in the piece's interval, else an interval end
+        ex = segs[:, 2] - segs[:, 0]
+        ey = segs[:, 3] - segs[:, 1]
+        wx = self.origin[0] - segs[:, 0]
+        wy = self.origin[1] - segs[:, 1]
+        u = np.clip((wx * ex + wy * ey) / (ex**2 + ey**2), 0, 1)
+        foot_x = segs[:, 0] + u * ex - self.origin[0]
+        foot_y = segs[:, 1] + u * ey - self.origin[1]
+        foot_ang = np.arctan2(foot_y, foot_x) % (2 * np.pi)
+        foot_in = (foot_ang >= lo) & (foot_ang <= hi)
+
+        cand_d = np.stack((np.where(foot_in, np.hypot(foot_x, foot_y), np.inf),
+                           _ray_segment_distance(segs, self.origin, np.cos(lo), np.sin(lo)),
+                           _ray_segment_distance(segs, self.origin, np.cos(hi), np.sin(hi))))
+        cand_a = np.stack((foot_ang, lo, hi))
+        cand_d = np.where(np.isfinite(cand_d) & (cand_d >= 0), cand_d, np.inf)
+        k, j = np.unravel_index(np.argmin(cand_d), cand_d.shape)
+        return float(cand_d[k, j]), float(cand_a[k, j])
+
+    def vertices(self):
+        """(M, 2) polygon vertices (x, y), two per interval. Intervals seeing
+        nothing are skipped."""
+        ends = np.append(self.starts[1:], 2 * np.pi)
+        seen = self.seg_ids >= 0
+        ang = np.column_stack((self.starts[seen], ends[seen])).ravel()
+        ids = np.repeat(self.seg_ids[seen], 2)
+        t = _ray_segment_distance(self.segments[ids], self.origin, np.cos(ang), np.sin(ang))
+        return np.column_stack((self.origin[0] + t * np.cos(ang), self.origin[1] + t * np.sin(ang)))
+
+
+class ObstacleIndex():
+    """Spatial index over occupied cells for nearest-obstacle queries.
+
+    Uses scipy's cKDTree if available, otherwise buckets the cells into a
+    grid of bucket_size x bucket_size cells and searches rings of buckets
+    around the query. Distances are to cell centers (integer x, y), like
+    the map's distance field.
+
+    Queries take a single point (2, ) or a batch (N, 2) of (x, y) and return
+    results shaped accordingly.
+
+    Parameters
+    ----------
+    occupied : (H, W) bool np.ndarray or PackedOccupancy
+        indexed [y, x]
+    bucket_size : int
+        bucket width in cells for the numpy fallback
+    """
+
+    def __init__(self, occupied, bucket_size=8):
+        if isinstance(occupied, PackedOccupancy):
+            occupied = occupied.unpack()
+        ys, xs = np.nonzero(occupied)
+        self.cells = np.column_stack((xs, ys)).astype(np.int64)
+        self.shape = occupied.shape
+        self.bucket_size = bucket_size
+        self.tree = None
+        if cKDTree is not None and len(self.cells):
+            self.tree = cKDTree(self.cells)
+            return
+
+        # Cells sorted by bucket, bucket b holding cells[bucket_start[b]:bucket_start[b + 1]]
+        self.n_bx = -(-self.shape[1] // bucket_size)
+        self.n_by = -(-self.shape[0] // bucket_size)
+        bucket = (ys // bucket_size) * self.n_bx + xs // bucket_size
+        order = np.argsort(bucket, kind="stable")
+        self.cells = self.cells[order]
+        self.bucket_start = np.searchsorted(bucket[order], np.arange(self.n_bx * self.n_by + 1))
+
+    def __len__(self):
+        return len(self.cells)
+
+    def _bucket_cells(self, bx0, by0, bx1, by1):
+        """Cells in buckets bx0..bx1, by0..by1 (inclusive, clipped to the grid)."""
+        bx0, by0 = max(bx0, 0), max(by0, 0)
+        bx1, by1 = min(bx1, self.n_bx - 1), min(by1, self.n_by - 1)
+        if bx0 > bx1 or by0 > by1:
+            return self.cells[:0]
+        rows = np.arange(by0, by1 + 1) * self.n_bx
+        # buckets of one bucket row are contiguous in self.cells
+        starts = self.bucket_start[rows + bx0]
+        ends = self.bucket_start[rows + bx1 + 1]
+        return np.concatenate([self.cells[a:b] for a, b in zip(starts.tolist(), ends.tolist())])
+
+    def _k_nearest_buckets(self, point, k):
+        """k nearest cells of one point, searching a square window of buckets
+        that doubles until it provably holds them."""
+        bs = self.bucket_size
+        bx = min(max(int(point[0] // bs), 0), self.n_bx - 1)
+        by = min(max(int(point[1] // bs), 0), self.n_by - 1)
+        r_max = max(bx, by, self.n_bx - 1 - bx, self.n_by - 1 - by)
+        r = 0
+        while True:
+            cells = self._bucket_cells(bx - r, by - r, bx + r, by + r)
+            dist = np.hypot(cells[:, 0] - point[0], cells[:, 1] - point[1])
+            # cells outside the window are more than r * bucket_size away
+            if r >= r_max or (len(dist) >= k and np.partition(dist, k - 1)[k - 1] <= r * bs):
+                break
+            r = min(max(2 * r, 1), r_max)
+        order = np.argsort(dist, kind="stable")[:k]
+        return dist[order], cells[order]
+
+    def k_nearest(self, points, k=1):
+        """Distances (..., k) and cells (..., k, 2) of the k closest occupied
+        cells, closest first. Padded with inf and -1 if there are fewer than k."""
+        points = np.asarray(points, dtype=float)
+        batch = points.reshape(-1, 2)
+        dist = np.full((len(batch), k), np.inf)
+        cells = np.full((len(batch), k, 2), -1, dtype=np.int64)
+        n = min(k, len(self.cells))
+        if n:
+            if self.tree is not None:
+                d, idx = self.tree.query(batch, k=n)
+                d, idx = d.reshape(len(batch), n), idx.reshape(len(batch), n)
+                dist[:, :n] = d
+                cells[:, :n] = self.cells[idx]
+            else:
+                for i, point in enumerate(batch):
+                    dist[i, :n], cells[i, :n] = self._k_nearest_buckets(point, n)
+        return dist.reshape(points.shape[:-1] + (k,)), cells.reshape(points.shape[:-1] + (k, 2))
+
+    def nearest(self, points):
+        """Distance (...) and cell (..., 2) of the closest occupied cell.
+        inf and (-1, -1) on a map without obstacles."""
+        dist, cells = self.k_nearest(points, 1)
+        return dist[..., 0], cells[..., 0, :]
+
+    def within_radius(self, points, radius):
+        """Cells (M, 2) within radius of a point, closest first, and their
+        distances (M, ). For a batch of points, a list of such pairs."""
+        points = np.asarray(points, dtype=float)
+        results = []
+        for point in points.reshape(-1, 2):
+            if self.tree is not None:
+                cells = self.cells[self.tree.query_ball_point(point, radius)].reshape(-1, 2)
+            elif len(self.cells):
+                bs = self.bucket_size
+                cells = self._bucket_cells(int((point[0] - radius) // bs), int((point[1] - radius) // bs),
+                                           int((point[0] + radius) // bs), int((point[1] + radius) // bs))
+            else:
+                cells = self.cells
+            dist = np.hypot(cells[:, 0] - point[0], cells[:, 1] - point[1])
+            order = np.argsort(dist, kind="stable")
+            order = order[dist[order] <= radius]
+            results.append((cells[order], dist[order]))
+        return results[0] if points.ndim == 1 else results
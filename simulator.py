@@ -9,27 +9,78 @@ import numpy as np
 import matplotlib.pyplot as plt
 import math
 import random
+import os
+import hashlib
+import tempfile
+import itertools
+from collections import OrderedDict
 from bresenham import bresenham
-from dynamics import QuadDynamics
+from dynamics import QuadDynamics, QuadState, dt
 from dynamics import basic_input
 from controller import *
+from sim_utils import bresenham_raycast, sphere_trace_raycast, pyramid_raycast, OccupancyPyramid
+from history import HistoryRecorder
+from scheduler import MultiRateScheduler
+from sim_utils import euclidean_distance_transform, bilinear_interpolate, PackedOccupancy
+from sim_utils import QuantizedField
+from sim_utils import grid_to_rects, rects_to_segments, ray_segment_raycast, VisibilityPolygon
+from sim_utils import split_crossing_segments
+from sim_utils import ObstacleIndex
 
 MAX_RANGE = 1000
 DISPSCALE = 5
 SAFE_RANGE = 30
+CONTROL_DT = 0.1  # default controller period (s)
+LIDAR_DT = 0.1  # default lidar scan period (s)
+MAX_SPEED = 20  # assumed bound on robot speed (cells/s), for skip_scans
+CELL_HALF_DIAGONAL = math.sqrt(2) / 2
+MAP_CACHE_DIR = "__mapcache__"
+MAP_STORAGES = ("float", "bool", "bits")
+DISTANCE_STORAGES = ("float64", "float32", "uint16")
+_map_uids = itertools.count()
 
 class Robot():
-    def __init__(self, map1, lidar=None, pos_cont=None, use_safe=True):
-        self.state = {"x": np.array([50, 10, 10]),
-                      "xdot": np.zeros(3,),
-                      "theta": np.radians(np.array([0, 0, 0])),  # ! hardcoded
-                      "thetadot": np.radians(np.array([0, 0, 0]))
-                      }
+    go_to_position = staticmethod(go_to_position)  # attribute so a profiler can wrap it
+
+    def __init__(self, map1, lidar=None, pos_cont=None, use_safe=True, history=None,
+                 start_pos=(50, 10), dynamics_dt=dt, control_dt=CONTROL_DT, lidar_dt=LIDAR_DT,
+                 integrator="euler", skip_scans=False, max_speed=MAX_SPEED, profiler=None):
+        """start_pos : (x, y) or (x, y, yaw in deg) initial pose
+
+        dynamics_dt, control_dt, lidar_dt : periods (s) of the dynamics step,
+        the controllers (PositionController and go_to_position) and the lidar
+        scan. control_dt and lidar_dt must be multiples of dynamics_dt. Each
+        update() advances the slowest of them.
+
+        integrator : QuadDynamics integrator, ex. "rk4" to keep dynamics
+        accurate with larger dynamics_dt. Warning: every integrator but the
+        default "euler" solves the rigid-body equations, which "euler" does
+        not converge to, so switching changes the physics (trajectories
+        differ from any "euler" run), see QuadDynamics.
+
+        skip_scans : reuse the last lidar scan while the robot provably
+        cannot have come within SAFE_RANGE of an obstacle since, so a new
+        scan would not change the safe control (see can_reuse_scan()).
+        max_speed bounds the distance travelled (cells/s).
+
+        profiler : profiler.StageProfiler or None
+            times update() and its lidar.update_reading,
+            pos_cont.calc_control, go_to_position and dynamics.step_dynamics
+            calls. Nothing is instrumented if None.
+        """
+        start_yaw = start_pos[2] if len(start_pos) > 2 else 0
+        self.state = QuadState(x=np.array([start_pos[0], start_pos[1], 10]),
+                               theta=np.radians(np.array([0, 0, start_yaw])),
+                               thetadot=np.radians(np.array([0, 0, 0])))
         self.x = self.state["x"][0]
         self.y = self.state["x"][1]
-        self.dynamics = QuadDynamics()
-        self.hist_x = []
-        self.hist_y = [] 
+        self.dynamics = QuadDynamics(dt=dynamics_dt, integrator=integrator)
+        self.u = np.zeros(4)
+        # TODO: cleaner way?
+        if history is None:
+            self.history = HistoryRecorder({"pos": 2})
+        else:
+            self.history = history
         self.map = map1
         self.use_safe = use_safe
 
@@ -44,7 +95,39 @@ class Robot():
             self.pos_cont = PositionController(self.lidar)
         else:
             self.pos_cont = pos_cont
+
+        self.skip_scans = skip_scans
+        self.max_speed = max_speed
+        self.n_scans = 0
+        self.n_skipped_scans = 0
+        self.scan_pos = None  # where the last scan was taken
+        self.scan_time = 0
+        self.scan_clearance = 0  # clearance_bound() at scan_pos
+        self.scan_map_version = None
+
+        # runs in this order when due on the same tick
+        self.scheduler = MultiRateScheduler(dynamics_dt)
+        self.scheduler.add_task("lidar", lidar_dt, self.sense)
+        self.scheduler.add_task("control", control_dt, self.control)
+        self.scheduler.add_task("dynamics", dynamics_dt, self.step_dynamics)
+        self.update_dt = max(dynamics_dt, control_dt, lidar_dt)
+
+        self.profiler = profiler
+        if profiler is not None:
+            profiler.instrument(self, "update", "robot.update")
+            profiler.instrument(self.lidar, "update_reading", "lidar.update_reading")
+            profiler.instrument(self.pos_cont, "calc_control", "pos_cont.calc_control")
+            profiler.instrument(self, "go_to_position", "go_to_position")
+            profiler.instrument(self.dynamics, "step_dynamics", "dynamics.step_dynamics")
     
+    @property
+    def hist_x(self):
+        return self.history["pos"][:, 0]
+
+    @property
+    def hist_y(self):
+        return self.history["pos"][:, 1]
+
     def visualize_robot(self):
         plt.plot(self.x, self.y, "*r")
         plt.plot(self.hist_x, self.hist_y, ".")
@@ -55,37 +138,281 @@ class Robot():
         self.lidar.visualize_lidar((self.x, self.y))
         self.pos_cont.visualize_control((self.x, self.y))
 
-    def move(self):
-        self.hist_x.append(self.x)
-        self.hist_y.append(self.y)
-
+    def sense(self):
+        if self.skip_scans and self.can_reuse_scan():
+            self.n_skipped_scans += 1
+            return
+        # without beams in the control, trace only if something reads them
+        self.lidar.update_reading((self.x, self.y), self.state["theta"][2],
+                                  lazy=not self.pos_cont.needs_beams)
+        self.n_scans += 1
+        if self.skip_scans:
+            self.scan_pos = (self.x, self.y)
+            self.scan_time = self.scheduler.time
+            self.scan_clearance = self.clearance_bound()
+            self.scan_map_version = self.map.version
+
+    def clearance_bound(self):
+        """Lower bound on the closest obstacle distance the lidar and the
+        position controller can measure: the distance field at the nearest
+        map cell, minus the distance to that cell (and a little for float32
+        fields). The field is to occupied cell centers, so the map's
+        segment_margin is subtracted too when ranges are measured to
+        obstacle edges (lidar method "geometric" or "visibility", or
+        nearest_method "visibility")."""
+        cx = min(max(int(round(self.x)), 0), self.map.width - 1)
+        cy = min(max(int(round(self.y)), 0), self.map.height - 1)
+        bound = (float(self.map.distance_field[cy, cx]) - 1e-3 -
+                 math.hypot(self.x - cx, self.y - cy))
+        if (self.lidar.method in ("geometric", "visibility") or
+                self.pos_cont.nearest_method == "visibility"):
+            bound -= self.map.segment_margin
+        return bound
+
+    def can_reuse_scan(self):
+        """True if the last scan gives the same safe control as a new one.
+
+        Measured ranges are never below clearance_bound(), which drops at
+        most as fast as the robot moves. So while clearance_bound() at the last scan minus the
+        distance the robot could have travelled since (max_speed * elapsed
+        time, or the actual displacement if larger) stays at or above
+        SAFE_RANGE, both scans keep min range outside SAFE_RANGE.
+        """
+        if self.scan_pos is None or self.scan_map_version != self.map.version:
+            return False
+        travelled = max(self.max_speed * (self.scheduler.time - self.scan_time),
+                        math.hypot(self.x - self.scan_pos[0], self.y - self.scan_pos[1]))
+        return self.scan_clearance - travelled >= SAFE_RANGE
+
+    def control(self):
+        """Safe position control on the last scan, then motor inputs, held
+        until the next control tick."""
+        self.pos_cont.calc_control(self.use_safe, (self.x, self.y, self.state["theta"][2]))
         des_pos = np.array(
             [self.x+self.pos_cont.u_x * 20, self.y+self.pos_cont.u_y * 20, 10]) #! TODO: make u_x reasonable
-        u = go_to_position(self.state, des_pos, param_dict=self.dynamics.param_dict)
-        self.state = self.dynamics.step_dynamics(self.state, u)
+        self.u = self.go_to_position(self.state, des_pos, param_dict=self.dynamics.param_dict)
+
+    def step_dynamics(self):
+        self.state = self.dynamics.step_dynamics(self.state, self.u)
         self.x = self.state["x"][0]
         self.y = self.state["x"][1]
-        
 
     def update(self):
-        """Moves robot and updates sensor readings"""
-
-        self.lidar.update_reading((self.x, self.y), self.state["theta"][2])
-        self.pos_cont.calc_control(self.use_safe)
-        self.move()
+        """Moves robot and updates sensor readings, running each component
+        at its own rate for update_dt seconds"""
+        self.history.append(pos=(self.x, self.y))
+        self.scheduler.run_for(self.update_dt)
         
         
 
 
+def load_map_grid(src_path_map, use_cache=True):
+    """Load occupancy grid from text file, flipped so that row index is y.
+
+    With use_cache, the parsed grid is saved as a .npy file in MAP_CACHE_DIR
+    next to the source, named by a hash of the source contents and mtime.
+    Later loads memory-map that file copy-on-write instead of parsing text,
+    so processes loading the same map share its pages until one of them
+    edits its grid (edits stay private and never reach the cache file).
+    """
+    if not use_cache:
+        return np.flipud(np.genfromtxt(src_path_map))
+
+    with open(src_path_map, "rb") as src_file:
+        digest = hashlib.sha1(src_file.read())
+    digest.update(str(os.stat(src_path_map).st_mtime_ns).encode())
+    src_dir, src_name = os.path.split(os.path.abspath(src_path_map))
+    cache_dir = os.path.join(src_dir, MAP_CACHE_DIR)
+    cache_path = os.path.join(cache_dir, src_name + "." + digest.hexdigest()[:16] + ".npy")
+
+    if not os.path.exists(cache_path):
+        grid = np.ascontiguousarray(np.flipud(np.genfromtxt(src_path_map)))
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # write to temp file and rename, so other processes never see
+            # a partial cache file
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as tmp_file:
+                np.save(tmp_file, grid)
+            os.replace(tmp_path, cache_path)
+            # drop caches of older versions of this map
+            for name in os.listdir(cache_dir):
+                if (name.startswith(src_name + ".") and name.endswith(".npy")
+                        and os.path.join(cache_dir, name) != cache_path):
+                    os.remove(os.path.join(cache_dir, name))
+        except OSError:
+            return grid  # read-only location, just skip caching
+
+    return np.load(cache_path, mmap_mode="c")
+
+
 class Map():
-    def __init__(self, src_path_map):
-        self.map = np.flipud(np.genfromtxt(src_path_map))
+    def __init__(self, src_path_map, use_cache=True, storage="float", distance_storage=None):
+        """Occupancy grid map from text file (or from an (H, W) array indexed
+        [y, x]). use_cache: see load_map_grid()
+
+        storage : "float" keeps the grid as read (8 bytes per cell).
+                  "bool" keeps only occupancy (value > 0.99), 1 byte per cell.
+                  "bits" packs occupancy 8 cells per byte.
+        Raycasting and distance queries give the same results for all three.
+
+        distance_storage : type of the distance field, built on first use by
+            the sphere_trace lidar, distance_to_obstacle() (the default
+            clearance metric of evaluate.py) and Robot skip_scans.
+            "float64" (8 bytes per cell, default for "float" storage),
+            "float32" (4 bytes, default otherwise) or "uint16" (2 bytes,
+            QuantizedField: rounded down to 1/16 cell, saturating at 4095
+            cells; sphere_trace hits stay exact).
+        The grid storage alone does not bound memory: once built, the
+        distance field dominates ("bits" grid + float32 field is 33 bits per
+        cell). The bresenham and pyramid lidars never build it (the pyramid
+        adds about 1/3 bit per cell with "bits").
+        """
+        if storage not in MAP_STORAGES:
+            raise ValueError("Unknown map storage " + str(storage) +
+                             ", expected one of " + str(MAP_STORAGES))
+        if distance_storage is None:
+            distance_storage = "float64" if storage == "float" else "float32"
+        if distance_storage not in DISTANCE_STORAGES:
+            raise ValueError("Unknown distance storage " + str(distance_storage) +
+                             ", expected one of " + str(DISTANCE_STORAGES))
+        self.storage = storage
+        self.distance_storage = distance_storage
+        self.uid = next(_map_uids)  # identity for caches, never reused
+        self.version = 0
+        if isinstance(src_path_map, np.ndarray):
+            self.map = src_path_map
+        else:
+            self.map = load_map_grid(src_path_map, use_cache)
         self.width = self.map.shape[1] #TODO: check
         self.height = self.map.shape[0]
         self.max_dist = math.sqrt(self.width**2 + self.height**2)
         print("Finished reading map of width " + 
             str(self.width) + "and height " + str(self.height))
 
+    @property
+    def map(self):
+        """Grid as float array indexed [y, x]. Decoded on every access unless
+        storage is "float"."""
+        if self._map is not None:
+            return self._map
+        if self.storage == "bits":
+            return self._occupancy.unpack().astype(float)
+        return self._occupancy.astype(float)
+
+    @map.setter
+    def map(self, grid):
+        if self.storage == "float":
+            self._map = grid
+            self._occupancy = None  # built on first use
+        elif self.storage == "bool":
+            self._map = None
+            self._occupancy = np.ascontiguousarray(grid > 0.99)
+        else:
+            self._map = None
+            self._occupancy = PackedOccupancy(grid > 0.99)
+        self.mark_changed()
+
+    def mark_changed(self):
+        """Drop everything derived from the grid. Called when map.map is
+        assigned; call it after editing the grid in place."""
+        if self._map is not None:
+            self._occupancy = None
+        self._distance_field = None
+        self._pyramid = None
+        self._segments = None
+        self._obstacle_index = None
+        self.version += 1
+
+    @property
+    def occupancy(self):
+        """Occupancy grid, indexed [ys, xs] with integer arrays (a bool
+        np.ndarray or PackedOccupancy)."""
+        if self._occupancy is None:
+            self._occupancy = self._map > 0.99
+        return self._occupancy
+
+    def is_occupied(self, xs, ys):
+        """Occupancy of integer cells (x, y). Cells outside the map are free."""
+        xs = np.asarray(xs, dtype=np.int64)
+        ys = np.asarray(ys, dtype=np.int64)
+        inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        occ = np.zeros(np.shape(inside), dtype=bool)
+        occ[inside] = self.occupancy[ys[inside], xs[inside]]
+        return occ
+
+    @property
+    def nbytes(self):
+        """Memory used by the stored grid."""
+        return (self._map if self._map is not None else self._occupancy).nbytes
+
+    @property
+    def occupancy_pyramid(self):
+        """Max-pooled OccupancyPyramid of the map. Built on first use, then reused."""
+        if self._pyramid is None:
+            self._pyramid = OccupancyPyramid(self.occupancy)
+        return self._pyramid
+
+    @property
+    def obstacle_index(self):
+        """ObstacleIndex over the occupied cells. Built on first use, then reused."""
+        if self._obstacle_index is None:
+            self._obstacle_index = ObstacleIndex(self.occupancy)
+        return self._obstacle_index
+
+    @property
+    def obstacle_rects(self):
+        """(R, 4) x0, y0, x1, y1 cell rectangles covering all occupied cells."""
+        return grid_to_rects(self.occupancy)
+
+    @property
+    def obstacle_segments(self):
+        """(E, 4) ax, ay, bx, by obstacle boundary segments, where cell (x, y)
+        covers [x - 0.5, x + 0.5] x [y - 0.5, y + 0.5]. Built on first use."""
+        if self._segments is None:
+            self._segments = rects_to_segments(self.obstacle_rects)
+        return self._segments
+
+    @property
+    def segment_margin(self):
+        """Upper bound on the distance from a point of obstacle_segments to
+        the closest occupied cell center, i.e. how much closer than the
+        distance field the edge-measuring lidar methods can see obstacles."""
+        return CELL_HALF_DIAGONAL
+
+    @property
+    def distance_field(self):
+        """Distance (in cells) from every cell to the closest obstacle, an
+        (H, W) np.ndarray or QuantizedField (see distance_storage). Built on
+        first use, then reused."""
+        if self._distance_field is None:
+            if self.distance_storage == "uint16":
+                self._distance_field = QuantizedField(euclidean_distance_transform(self.occupancy))
+            else:
+                self._distance_field = euclidean_distance_transform(
+                    self.occupancy, dtype=self.distance_storage)
+        return self._distance_field
+
+    def distance_to_obstacle(self, pos):
+        """Get distance to closest obstacle, bilinearly interpolated from the
+        distance field.
+
+        Parameters
+        ----------
+        pos : (2, ) or (N, 2) array-like
+            (x, y) position(s) in map coordinate
+
+        Returns
+        -------
+        dist : float or (N, ) np.ndarray
+        """
+        pos = np.asarray(pos, dtype=float)
+        dist = bilinear_interpolate(
+            self.distance_field, pos[..., 0].ravel(), pos[..., 1].ravel())
+        if pos.ndim == 1:
+            return dist[0]
+        return dist
+
     def visualize_map(self):
         # x = np.arange(0, self.height)
         # y = np.arange(0, self.width)
@@ -98,18 +425,120 @@ class Map():
         plt.ylabel("y")
 
 
+class GeometricMap(Map):
+    """Map described by axis-aligned obstacle rectangles and line segments,
+    for lidar method "geometric".
+
+    Either built from a grid (file or array, as Map), covering occupied cells
+    with rectangles merged from row runs, or from given rects (x0, y0, x1, y1
+    in inclusive cells) and segments (ax, ay, bx, by) on a width x height map.
+    Given shapes are also rasterized into the grid, so grid-based queries
+    (other lidar methods, distance field) keep working.
+    """
+
+    def __init__(self, src_path_map=None, rects=None, segments=None, width=None, height=None,
+                 use_cache=True, storage="float", distance_storage=None):
+        self.rects = None if rects is None else np.asarray(rects, dtype=np.int64).reshape(-1, 4)
+        self.segments = None if segments is None else np.asarray(segments, dtype=float).reshape(-1, 4)
+        self._margin = None  # (map version, segment_margin)
+        if src_path_map is None:
+            if width is None or height is None:
+                raise ValueError("width and height are needed without a grid")
+            src_path_map = self.rasterize(width, height)
+        super().__init__(src_path_map, use_cache, storage, distance_storage)
+
+    def rasterize(self, width, height):
+        """Grid with every cell touched by the given rects and segments occupied."""
+        grid = np.zeros((height, width))
+        if self.rects is not None:
+            for x0, y0, x1, y1 in self.rects:
+                grid[max(y0, 0):max(y1 + 1, 0), max(x0, 0):max(x1 + 1, 0)] = 1
+        if self.segments is not None:
+            for ax, ay, bx, by in self.segments:
+                for x, y in bresenham(int(round(ax)), int(round(ay)), int(round(bx)), int(round(by))):
+                    if 0 <= x < width and 0 <= y < height:
+                        grid[y, x] = 1
+        return grid
+
+    @property
+    def obstacle_rects(self):
+        if self.rects is not None:
+            return self.rects
+        return super().obstacle_rects
+
+    @property
+    def obstacle_segments(self):
+        """Edges of obstacle_rects plus the given segments. Given rects and
+        segments may overlap or cross, so they are split where they cross
+        (see split_crossing_segments()), once."""
+        if self._segments is None:
+            segments = rects_to_segments(self.obstacle_rects)
+            if self.segments is not None:
+                segments = np.concatenate((segments, self.segments))
+            if self.rects is not None or self.segments is not None:
+                segments = split_crossing_segments(segments)
+            self._segments = segments
+        return self._segments
+
+    @property
+    def segment_margin(self):
+        """Given segments need not pass through the centers of the cells
+        they were rasterized to, so their margin is measured by sampling
+        them every 0.1 cell (the parts inside the map)."""
+        if self.segments is None:
+            return super().segment_margin
+        if self._margin is None or self._margin[0] != self.version:
+            margin = CELL_HALF_DIAGONAL
+            step = 0.1
+            for ax, ay, bx, by in self.segments:
+                t = np.linspace(0, 1, int(math.hypot(bx - ax, by - ay) / step) + 2)
+                points = np.column_stack((ax + t * (bx - ax), ay + t * (by - ay)))
+                inside = np.all((points >= -0.5) &
+                                (points <= (self.width - 0.5, self.height - 0.5)), axis=1)
+                if np.any(inside):
+                    dist, cells = self.obstacle_index.nearest(points[inside])
+                    margin = max(margin, float(np.max(dist)) + step / 2)
+            self._margin = (self.version, margin)
+        return self._margin[1]
+
+
 class PositionController():
-    def __init__(self, lidar):
+    """nearest_method : where calc_safe_control() finds the closest obstacle.
+                        "beams" takes the closest lidar beam.
+                        "visibility" takes the exact closest point of the
+                        lidar's visibility polygon (see
+                        LidarSimulator.visibility_polygon).
+                        "index" takes the exact closest occupied cell from
+                        the map's ObstacleIndex, between beams too.
+                        Both query at the robot pose and need no beams, so
+                        Robot then traces the lidar only on demand (see
+                        LidarSimulator.update_reading).
+    """
+    NEAREST_METHODS = ("beams", "visibility", "index")
+
+    def __init__(self, lidar, nearest_method="beams"):
+        if nearest_method not in self.NEAREST_METHODS:
+            raise ValueError("Unknown nearest method " + str(nearest_method) +
+                             ", expected one of " + str(self.NEAREST_METHODS))
         self.u_x = 0
         self.u_y = 0
         self.og_control = (0,0)
         self.safe_control = (0,0)
         self.lidar = lidar
+        self.nearest_method = nearest_method
+
+    @property
+    def needs_beams(self):
+        """False if the control does not read the lidar beams, so the
+        scan can be skipped."""
+        return self.nearest_method == "beams"
 
-    def calc_control(self, use_safe):
+    def calc_control(self, use_safe, pose=None):
+        """pose : (x, y, yaw) of the robot, used by the "visibility" and
+        "index" nearest methods. Defaults to the pose of the last reading."""
         self.calc_original_control()
         if use_safe:
-            self.calc_safe_control()
+            self.calc_safe_control(pose)
         self.u_x = self.og_control[0] + self.safe_control[0]
         self.u_y = self.og_control[1] + self.safe_control[1]
 
@@ -121,14 +550,13 @@ class PositionController():
         self.og_control = (og_ux, og_uy)
         return (og_ux, og_uy)
 
-    def calc_safe_control(self):
+    def calc_safe_control(self, pose=None):
         # Naive: choose minimum distance and push away. should have equilibrium point when at stopping limit
         # min_angle_ind = np.argmin(self.lidar.ranges)
         # self.lidar.reset_unsafe_range()
         # self.lidar.unsafe_range[min_angle_ind] = 1
 
-        min_angle_ind = np.argmin(self.lidar.ranges)
-        min_range = np.min(self.lidar.ranges)
+        min_angle_ind, min_range, unsafe_angle = self.closest_obstacle(pose)
         self.lidar.reset_unsafe_range()
         
         if min_range < SAFE_RANGE:
@@ -136,7 +564,6 @@ class PositionController():
             self.lidar.unsafe_range[min_angle_ind] = 1
 
             # Push away
-            unsafe_angle = self.lidar.angles[min_angle_ind]
 
             # TODO: cast to int
             safe_ux = int((SAFE_RANGE - min_range)//10 * np.cos(unsafe_angle + np.pi))
@@ -150,6 +577,29 @@ class PositionController():
 
         self.safe_control = (safe_ux, safe_uy) #TODO
 
+    def closest_obstacle(self, pose=None):
+        """Closest obstacle of the last lidar reading ("beams"), or seen from
+        pose (x, y, yaw), default the pose of the last reading.
+
+        Returns
+        -------
+        beam index closest to it, range, angle (rad, lidar frame)
+        """
+        if self.nearest_method == "beams":
+            min_angle_ind = np.argmin(self.lidar.ranges)
+            return min_angle_ind, np.min(self.lidar.ranges), self.lidar.angles[min_angle_ind]
+
+        if pose is None:
+            pose = (self.lidar.pos[0], self.lidar.pos[1], self.lidar.cur_yaw)
+        pos = (pose[0], pose[1])
+        if self.nearest_method == "visibility":
+            min_range, angle = self.lidar.visibility_polygon(pos).closest_point()
+        else:
+            min_range, cell = self.lidar.map.obstacle_index.nearest(pos)
+            angle = math.atan2(cell[1] - pos[1], cell[0] - pos[0])
+        angle = angle - pose[2]
+        angle_err = np.abs((self.lidar.angles - angle + np.pi) % (2 * np.pi) - np.pi)
+        return np.argmin(angle_err), min_range, angle
 
 
     def visualize_control(self, pos):
@@ -167,13 +617,44 @@ class PositionController():
         plt.legend()
 
 class LidarSimulator():
-    def __init__(self, map1, angles=np.array(range(10)) * 33): 
+    """Simulated 2D lidar.
+
+    method : "bresenham" visits every grid cell along each beam (exact).
+             "sphere_trace" jumps along the same lines using the map's
+             distance field, so it skips open space but gives the same hits.
+             "pyramid" jumps over empty blocks of the map's occupancy
+             pyramid, also giving the same hits.
+             "geometric" intersects beams with the map's obstacle segments
+             (see GeometricMap), giving sub-cell hit points on obstacle
+             boundaries instead of cell centers.
+             "visibility" builds the visibility polygon of the obstacle
+             segments once per pose and samples every beam from it, so
+             dense scans (thousands of beams) cost little more than sparse
+             ones. Hits are the same as "geometric" (map segments are
+             split where they cross, see GeometricMap).
+    """
+    METHODS = ("bresenham", "sphere_trace", "pyramid", "geometric", "visibility")
+
+    def __init__(self, map1, angles=np.array(range(10)) * 33, method="bresenham", cache=None):
+        """cache : optional RaycastCache, may be shared between lidars"""
+        if method not in self.METHODS:
+            raise ValueError("Unknown lidar method " + str(method) +
+                             ", expected one of " + str(self.METHODS))
+        self.method = method
         self.range_noise = 0.0
         self.angles = angles * np.pi/180. # list in deg
+        self.cos_angles = np.cos(self.angles)
+        self.sin_angles = np.sin(self.angles)
         self.map = map1 #TODO: move to robot?
-        self.sensed_obs = None 
-        self.ranges = None
+        self.cache = cache
+        self.angles_key = hashlib.sha1(self.angles.tobytes()).hexdigest()
+        self._sensed_obs = None
+        self._ranges = None
+        self._pending = None  # (pos, yaw) of a deferred reading
+        self.pos = None
+        self.cur_yaw = 0
         self.unsafe_range = np.zeros_like(self.angles)
+        self._visibility = None
 
     def reset_unsafe_range(self):
         self.unsafe_range = np.zeros_like(self.angles)
@@ -185,13 +666,131 @@ class LidarSimulator():
 
         return list(bresenham(int(p1[0]), int(p1[1]), int(p2[0]), int(p2[1])))
 
-    def update_reading(self, pos, cur_yaw):
-        """Update sensed obstacle locations and ranges."""
-        closest_obs = [self.get_closest_obstacle(
-            pos, angle + cur_yaw) for angle in self.angles]
-        self.sensed_obs = np.array(closest_obs)
-
-        self.ranges = self.get_ranges(pos)
+    def update_reading(self, pos, cur_yaw, lazy=False):
+        """Update sensed obstacle locations and ranges. Traces all beams at once.
+
+        lazy : only record the pose, the beams are traced (by calling
+        update_reading again) when sensed_obs or ranges is next read
+        """
+        self.pos = (pos[0], pos[1])
+        self.cur_yaw = cur_yaw
+        if lazy:
+            self._pending = (self.pos, cur_yaw)
+            return
+        self._pending = None
+        self._sensed_obs, self._ranges = self.cast_beams(pos, cur_yaw)
+
+    @property
+    def sensed_obs(self):
+        """(N, 2) obstacle location sensed by each beam (nan if out of map)."""
+        if self._pending is not None:
+            self.update_reading(*self._pending)
+        return self._sensed_obs
+
+    @property
+    def ranges(self):
+        """(N, ) distance to sensed_obs."""
+        if self._pending is not None:
+            self.update_reading(*self._pending)
+        return self._ranges
+
+    def visibility_polygon(self, pos):
+        """VisibilityPolygon of the map's obstacle segments seen from pos,
+        kept until pos or the map changes."""
+        key = (float(pos[0]), float(pos[1]), self.map.uid, self.map.version)
+        if self._visibility is None or self._visibility[0] != key:
+            self._visibility = (key, VisibilityPolygon(self.map.obstacle_segments, pos))
+        return self._visibility[1]
+
+    def cast_beams(self, pos, cur_yaw):
+        """Get closest obstacle and range of every beam in one batched pass.
+        Gives the same results as calling get_closest_obstacle() per beam,
+        except beams with no cell inside the map give a NaN obstacle (instead
+        of None).
+
+        Returns
+        -------
+        sensed_obs : (N, 2) np.ndarray
+            closest obstacle (x, y) per beam, in map coordinate (NEU)
+        ranges : (N, ) np.ndarray
+            distance from pos to sensed_obs
+        """
+        if self.cache is not None:
+            sensed_obs, in_bounds = self.cache.lookup(self, pos, cur_yaw)
+        else:
+            sensed_obs, in_bounds = self.trace_beams(pos, cur_yaw)
+
+        ranges = np.sqrt((sensed_obs[:, 0] - pos[0])**2 +
+                         (sensed_obs[:, 1] - pos[1])**2)
+        ranges[~in_bounds] = 10000
+        return sensed_obs, ranges
+
+    def trace_beams(self, pos, cur_yaw):
+        """Trace all beams with the selected method.
+
+        Returns
+        -------
+        sensed_obs : (N, 2) np.ndarray
+            closest obstacle (x, y) per beam, NaN if no cell is in the map
+        in_bounds : (N, ) bool np.ndarray
+            True where the beam has at least one cell in the map
+        """
+        if cur_yaw == 0:
+            cos_beam, sin_beam = self.cos_angles, self.sin_angles
+        else:
+            beam_angles = self.angles + cur_yaw
+            cos_beam, sin_beam = np.cos(beam_angles), np.sin(beam_angles)
+
+        if self.method == "geometric":
+            return self.trace_beams_geometric(pos, cos_beam, sin_beam)
+        if self.method == "visibility":
+            return self.trace_beams_visibility(pos, self.angles + cur_yaw, cos_beam, sin_beam)
+
+        end_points = np.empty((len(self.angles), 2), dtype=np.int64)
+        end_points[:, 0] = np.rint(self.map.max_dist * cos_beam + pos[0])
+        end_points[:, 1] = np.rint(self.map.max_dist * sin_beam + pos[1])
+        start = (int(pos[0]), int(pos[1]))
+        if self.method == "sphere_trace":
+            hit_cells, hit, in_bounds = sphere_trace_raycast(
+                self.map.distance_field, start, end_points)
+        elif self.method == "pyramid":
+            hit_cells, hit, in_bounds = pyramid_raycast(
+                self.map.occupancy_pyramid, start, end_points)
+        else:
+            hit_cells, hit, in_bounds = bresenham_raycast(
+                self.map.occupancy, start, end_points)
+
+        # no obstacles
+        sensed_obs = np.column_stack(
+            (MAX_RANGE * cos_beam, MAX_RANGE * sin_beam))
+        sensed_obs[hit] = hit_cells[hit]
+        sensed_obs[~in_bounds] = np.nan
+        return sensed_obs, in_bounds
+
+    def trace_beams_geometric(self, pos, cos_beam, sin_beam):
+        """trace_beams() by ray-segment intersection."""
+        t, seg_idx = ray_segment_raycast(self.map.obstacle_segments, pos, cos_beam, sin_beam)
+        return self._segment_hits(pos, t, cos_beam, sin_beam)
+
+    def trace_beams_visibility(self, pos, beam_angles, cos_beam, sin_beam):
+        """trace_beams() by sampling the visibility polygon at pos."""
+        t = self.visibility_polygon(pos).ranges(beam_angles)
+        return self._segment_hits(pos, t, cos_beam, sin_beam)
+
+    def _segment_hits(self, pos, t, cos_beam, sin_beam):
+        """trace_beams() output from distances t along each beam (inf: no hit)."""
+        t = np.array(t, dtype=float)
+        # inside an obstacle, every beam hits right away
+        if self.map.is_occupied(int(round(pos[0])), int(round(pos[1]))):
+            t[:] = 0
+        hit = np.isfinite(t)
+
+        # no obstacles
+        sensed_obs = np.column_stack(
+            (MAX_RANGE * cos_beam, MAX_RANGE * sin_beam))
+        sensed_obs[hit, 0] = pos[0] + t[hit] * cos_beam[hit]
+        sensed_obs[hit, 1] = pos[1] + t[hit] * sin_beam[hit]
+        return sensed_obs, np.ones(len(t), dtype=bool)
 
     def get_ranges(self, pos):
         """Get ranges given sensed obstacles"""
@@ -218,9 +817,8 @@ class LidarSimulator():
         along_line_pts = np.array(along_line_pts)
         # plt.plot(along_line_pts[:,0], along_line_pts[:,1], '.')
         if along_line_pts.size > 0:
-            along_line_occ = self.map.map[along_line_pts[:,1], along_line_pts[:,0]]
-            # TODO: change to binary
-            closest_obs_coord = along_line_pts[np.where(along_line_occ > 0.99)]
+            along_line_occ = self.map.occupancy[along_line_pts[:,1], along_line_pts[:,0]]
+            closest_obs_coord = along_line_pts[np.where(along_line_occ)]
             if len(closest_obs_coord) == 0: # no obstacles
                 # TODO: make into constant
                 return [MAX_RANGE * np.cos(angle), MAX_RANGE * np.sin(angle)]
@@ -249,6 +847,75 @@ class LidarSimulator():
                  np.vstack((unsafe_obs[:, 1], np.ones(len(unsafe_obs)) * pos[1])), 'r', linewidth=0.5)
 
 
+class RaycastCache():
+    """LRU cache of complete lidar scans, shared by any number of lidars.
+
+    Scans are keyed by map identity and version, beam angle set, integer
+    robot cell and yaw quantized to yaw_resolution (rad). On a miss the scan
+    is traced from the cell corner (the same start cell Bresenham uses) at
+    the quantized yaw, so a cached scan can differ from an exact one by the
+    sub-cell offset and yaw rounding. Ranges are still computed from the
+    exact position. Entries for a map are dropped when its version changes
+    (see Map.mark_changed()).
+    """
+
+    def __init__(self, max_entries=4096, yaw_resolution=np.radians(1)):
+        self.max_entries = max_entries
+        self.yaw_resolution = yaw_resolution
+        self.entries = OrderedDict()
+        self.map_versions = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, lidar, pos, cur_yaw):
+        """Get (sensed_obs, in_bounds) for lidar at pos, tracing on a miss.
+        Returned arrays are shared with the cache and read-only."""
+        map1 = lidar.map
+        if self.map_versions.get(map1.uid, map1.version) != map1.version:
+            self.invalidate(map1.uid)
+        self.map_versions[map1.uid] = map1.version
+
+        yaw_bin = int(round(cur_yaw / self.yaw_resolution))
+        cell = (int(pos[0]), int(pos[1]))
+        key = (map1.uid, map1.version, lidar.angles_key, cell, yaw_bin)
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+
+        self.misses += 1
+        sensed_obs, in_bounds = lidar.trace_beams(cell, yaw_bin * self.yaw_resolution)
+        sensed_obs.setflags(write=False)
+        in_bounds.setflags(write=False)
+        self.entries[key] = (sensed_obs, in_bounds)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return sensed_obs, in_bounds
+
+    def invalidate(self, map_uid=None):
+        """Drop entries of one map (all maps if None)."""
+        if map_uid is None:
+            self.entries.clear()
+            return
+        for key in [key for key in self.entries if key[0] == map_uid]:
+            del self.entries[key]
+
+    @property
+    def nbytes(self):
+        """Memory held by cached scans."""
+        return sum(obs.nbytes + inb.nbytes for obs, inb in self.entries.values())
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self.entries), "nbytes": self.nbytes,
+                "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
 def calc_dist(p1, p2):
     return math.sqrt((p2[0]-p1[0])**2 + (p2[1]-p1[1])**2)
 
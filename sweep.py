@@ -0,0 +1,158 @@
+"""sweep.py
+Headless parallel experiment runner for safe control evaluation.
+
+Expands a sweep spec (JSON) into episodes, runs them across a process pool
+with evaluate.run_episode() and streams one JSON line of metrics per episode
+to the result file as soon as it finishes.
+
+`python sweep.py spec.json --out results.jsonl --workers 8`
+
+Spec keys (all optional, every combination is run):
+    maps          list of map files or glob patterns, ex. ["data/*.dat"]
+    start_poses   list of (x, y) or (x, y, yaw in deg)
+    use_safe      list of bool
+    lidar_angles  list of beam angle sets: null (robot default), a list of
+                  angles in deg, or {"n": N} for N evenly spaced beams
+    seeds         list of int, seeds start position noise. Episodes are
+                  deterministic otherwise, so with start_noise 0 only the
+                  first seed is run.
+    steps         list of int, number of steps per episode
+    start_noise   float, std. dev. of start position noise
+"""
+
+import matplotlib
+matplotlib.use("Agg")  # headless, never open windows
+
+import argparse
+import glob
+import itertools
+import json
+import multiprocessing
+import os
+import time
+import warnings
+
+import numpy as np
+
+from simulator import Map
+from evaluate import run_episode
+
+DEFAULT_SPEC = {
+    "maps": [os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "*.dat")],
+    "start_poses": [[50, 10]],
+    "use_safe": [True, False],
+    "lidar_angles": [None],
+    "seeds": [0],
+    "steps": [100],
+    "start_noise": 0.0,
+}
+
+# Maps loaded by this worker process, by path
+_map_cache = {}
+
+
+def expand_spec(spec):
+    """Turn a sweep spec into a list of episode parameter dicts."""
+    spec = dict(DEFAULT_SPEC, **spec)
+    maps = []
+    for pattern in spec["maps"]:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise ValueError("No map matches " + str(pattern))
+        maps.extend(matches)
+
+    lidar_angles = []
+    for angles in spec["lidar_angles"]:
+        if isinstance(angles, dict):
+            angles = (np.arange(angles["n"]) * 360. / angles["n"]).tolist()
+        lidar_angles.append(angles)
+
+    seeds = list(spec["seeds"])
+    if not spec["start_noise"] and len(seeds) > 1:
+        # seeds only change the start noise, every seed would rerun the same episodes
+        warnings.warn("start_noise is 0, running only seed " + str(seeds[0]) +
+                      " of " + str(len(seeds)))
+        seeds = seeds[:1]
+
+    episodes = []
+    for i, (map_path, start_pos, use_safe, angles, seed, steps) in enumerate(itertools.product(
+            maps, spec["start_poses"], spec["use_safe"], lidar_angles,
+            seeds, spec["steps"])):
+        episodes.append({"episode": i, "map": map_path, "start_pos": list(start_pos),
+                         "use_safe": bool(use_safe), "lidar_angles": angles,
+                         "seed": seed, "steps": int(steps),
+                         "start_noise": float(spec["start_noise"])})
+    return episodes
+
+
+def get_map(map_path):
+    """Load map once per worker process."""
+    if map_path not in _map_cache:
+        _map_cache[map_path] = Map(map_path)
+    return _map_cache[map_path]
+
+
+def run_sweep_episode(params):
+    """Worker: run one episode and return params merged with its metrics."""
+    t_start = time.time()
+    metrics = run_episode(get_map(params["map"]), start_pos=params["start_pos"],
+                          use_safe=params["use_safe"],
+                          lidar_angles=params["lidar_angles"],
+                          steps=params["steps"], seed=params["seed"],
+                          start_noise=params["start_noise"])
+    result = dict(params)
+    angles = result.pop("lidar_angles")
+    result["n_beams"] = None if angles is None else len(angles)
+    result.update(metrics)
+    result["wall_time"] = time.time() - t_start
+    return result
+
+
+def run_sweep(spec, out_path, workers=None):
+    """Run every episode of spec on a process pool, appending one JSON line per
+    finished episode to out_path. Returns the list of results."""
+    episodes = expand_spec(spec)
+    workers = workers or os.cpu_count()
+    print("Running " + str(len(episodes)) + " episodes on " + str(workers) + " workers")
+
+    results = []
+    with open(out_path, "a") as out_file, multiprocessing.Pool(workers) as pool:
+        for result in pool.imap_unordered(run_sweep_episode, episodes):
+            out_file.write(json.dumps(result) + "\n")
+            out_file.flush()
+            results.append(result)
+    return results
+
+
+def summarize(results):
+    """Print collision count and mean min clearance per safe / unsafe."""
+    for use_safe in (True, False):
+        group = [r for r in results if r["use_safe"] == use_safe]
+        if not group:
+            continue
+        n_collide = sum(r["collision_step"] is not None for r in group)
+        print(("Safe" if use_safe else "Unsafe") + ": " + str(len(group)) + " episodes, " +
+              str(n_collide) + " collisions, mean min clearance " +
+              str(round(np.mean([r["min_clearance"] for r in group]), 2)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("spec", nargs="?", help="sweep spec JSON file (default: all maps, safe and unsafe)")
+    parser.add_argument("--out", default="results.jsonl", help="result file, JSON lines (appended)")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes (default: all cores)")
+    args = parser.parse_args(argv)
+
+    spec = {}
+    if args.spec is not None:
+        with open(args.spec) as spec_file:
+            spec = json.load(spec_file)
+
+    t_start = time.time()
+    results = run_sweep(spec, args.out, args.workers)
+    summarize(results)
+    print("Time Elapsed:", time.time() - t_start)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""test_dynamics.py
+Accuracy of the QuadDynamics integrators against a fine-step reference.
+Run with `python -m pytest`.
+"""
+
+import numpy as np
+import pytest
+
+from dynamics import QuadDynamics, init_state, fused_step_numba
+
+T = 1.0  # simulated time (s)
+U = 408750. + np.array([200, 0, -200, 100.])  # slightly unbalanced hover input
+
+
+def open_loop(integrator, step, mode="numpy", **kwargs):
+    """Final [x, theta] after T seconds of constant input U."""
+    dyn = QuadDynamics(mode=mode, dt=step, integrator=integrator, **kwargs)
+    state = init_state()
+    state["xdot"] = np.array([1., -0.5, 0.2])
+    state["thetadot"] = np.array([0.3, -0.2, 0.5])
+    for i in range(int(round(T / step))):
+        state = dyn.step_dynamics(state, U)
+    return np.concatenate((state["x"], state["theta"]))
+
+
+@pytest.fixture(scope="module")
+def reference():
+    return open_loop("rk4", 1e-3)
+
+
+def error(integrator, step, reference, **kwargs):
+    return np.max(np.abs(open_loop(integrator, step, **kwargs) - reference))
+
+
+def test_rk4_converges_4th_order(reference):
+    err = [error("rk4", step, reference) for step in (0.1, 0.05, 0.025)]
+    assert err[0] < 1e-4
+    # halving dt cuts the error about 16x
+    assert err[0] / err[1] > 10 and err[1] / err[2] > 10
+
+
+def test_semi_implicit_converges_1st_order(reference):
+    err = [error("semi_implicit", step, reference) for step in (0.02, 0.01, 0.005)]
+    assert err[0] < 0.1
+    assert 1.6 < err[0] / err[1] < 2.5 and 1.6 < err[1] / err[2] < 2.5
+
+
+def test_rk45_meets_tolerance(reference):
+    assert error("rk45", 0.1, reference, rtol=1e-9, atol=1e-12) < 1e-8
+    assert error("rk45", 0.1, reference) < 1e-4
+
+
+def test_rk45_max_substeps():
+    dyn = QuadDynamics(dt=0.1, integrator="rk45", rtol=1e-12, atol=1e-14, max_substeps=5)
+    with pytest.raises(RuntimeError):
+        dyn.step_dynamics(init_state(), U)
+
+
+def test_euler_is_a_different_ode(reference):
+    # "euler" carries thetadot instead of omega between steps and does not
+    # converge to the rigid-body solution the other integrators solve
+    err = [error("euler", step, reference) for step in (0.01, 0.001)]
+    assert min(err) > 0.05
+    assert err[1] > 0.5 * err[0]
+
+
+@pytest.mark.parametrize("mode", ["fused"] + (["numba"] if fused_step_numba is not None else []))
+def test_euler_modes_match_numpy(mode):
+    np.testing.assert_allclose(open_loop("euler", 0.01, mode=mode),
+                               open_loop("euler", 0.01), rtol=1e-12, atol=1e-12)
@@ -0,0 +1,69 @@
+"""test_raycast.py
+Batched grid raycasters agree with per-beam Bresenham
+(LidarSimulator.get_closest_obstacle), and the visibility lidar with the
+geometric one. Run with `python -m pytest`.
+"""
+
+import warnings
+
+import numpy as np
+import pytest
+
+from simulator import Map, GeometricMap, LidarSimulator
+
+GRID_METHODS = ("bresenham", "sphere_trace", "pyramid")
+
+
+def random_map(rng, height, width, density, **map_kwargs):
+    grid = (rng.random((height, width)) < density).astype(float)
+    return Map(grid, **map_kwargs)
+
+
+def reference_hits(lidar, pos, yaw):
+    hits = []
+    for angle in lidar.angles + yaw:
+        obs = lidar.get_closest_obstacle(pos, angle)
+        hits.append((np.nan, np.nan) if obs is None else obs)
+    return np.array(hits, dtype=float)
+
+
+@pytest.mark.parametrize("method", GRID_METHODS)
+@pytest.mark.parametrize("storage", [("float", None), ("bits", "uint16")])
+@pytest.mark.parametrize("seed", range(5))
+def test_matches_bresenham(method, storage, seed):
+    rng = np.random.default_rng(seed)
+    map1 = random_map(rng, rng.integers(20, 80), rng.integers(20, 80),
+                      rng.choice([0.005, 0.05, 0.2]),
+                      storage=storage[0], distance_storage=storage[1])
+    lidar = LidarSimulator(map1, angles=np.linspace(0, 360, 73)[:-1], method=method)
+    for i in range(10):
+        # some poses start outside the grid
+        pos = (int(rng.integers(-10, map1.width + 10)), int(rng.integers(-10, map1.height + 10)))
+        yaw = rng.uniform(-np.pi, np.pi)
+        sensed_obs, ranges = lidar.cast_beams(pos, yaw)
+        np.testing.assert_array_equal(sensed_obs, reference_hits(lidar, pos, yaw))
+
+
+@pytest.mark.parametrize("method", GRID_METHODS)
+def test_empty_map(method):
+    map1 = Map(np.zeros((40, 50)))
+    lidar = LidarSimulator(map1, angles=np.arange(0, 360, 15), method=method)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        sensed_obs, ranges = lidar.cast_beams((20, 10), 0.3)
+    np.testing.assert_array_equal(sensed_obs, reference_hits(lidar, (20, 10), 0.3))
+
+
+def test_visibility_matches_geometric_with_crossings():
+    # given rects and segments cross each other, map segments get split
+    rng = np.random.default_rng(0)
+    map1 = GeometricMap(rects=[(40, 40, 60, 60), (55, 30, 75, 45)],
+                        segments=[(30, 50, 70, 52), (50, 20, 52, 80), (10, 10, 90, 85)],
+                        width=100, height=100)
+    angles = np.arange(3600) / 10.
+    geometric = LidarSimulator(map1, angles=angles, method="geometric")
+    visibility = LidarSimulator(map1, angles=angles, method="visibility")
+    for i in range(20):
+        pos = rng.uniform(0, 99, 2)
+        np.testing.assert_allclose(visibility.cast_beams(pos, 0.2)[0],
+                                   geometric.cast_beams(pos, 0.2)[0], atol=1e-9)
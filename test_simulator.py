@@ -0,0 +1,69 @@
+"""test_simulator.py
+Map distance queries and Robot-level behaviour. Run with `python -m pytest`.
+"""
+
+import warnings
+
+import numpy as np
+import pytest
+
+from simulator import Map, GeometricMap, Robot, LidarSimulator, PositionController
+from evaluate import distance_to_closest_obstacle, run_episode
+
+
+def test_empty_map_distance_is_inf():
+    map1 = Map(np.zeros((50, 50)))
+    robot = Robot(map1, start_pos=(20, 20))
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", RuntimeWarning)
+        robot.update()
+        assert distance_to_closest_obstacle(robot) == np.inf
+        np.testing.assert_array_equal(
+            map1.distance_to_obstacle(np.array([[0., 0.], [12.3, 45.6], [49., 49.]])), np.inf)
+        result = run_episode(map1, start_pos=(20, 20), steps=20)
+    assert result["min_clearance"] == np.inf and result["mean_clearance"] == np.inf
+
+
+@pytest.mark.parametrize("method", LidarSimulator.METHODS)
+@pytest.mark.parametrize("geometric", [False, True])
+def test_clearance_bound_below_ranges(method, geometric):
+    # skip_scans relies on no beam (or visibility nearest point) ever being
+    # closer than Robot.clearance_bound()
+    rng = np.random.default_rng(1)
+    if geometric:
+        map1 = GeometricMap(rects=[(40, 40, 60, 60)],
+                            segments=[(10.3, 20.7, 80.2, 35.1), (20.6, 70.4, 30.2, 90.9)],
+                            width=100, height=100)
+    else:
+        map1 = Map("data/two_obs.dat")
+    lidar = LidarSimulator(map1, angles=np.arange(720) / 2., method=method)
+    nearest_method = "visibility" if method == "visibility" else "beams"
+    robot = Robot(map1, lidar=lidar, pos_cont=PositionController(lidar, nearest_method))
+    n_checked = 0
+    while n_checked < 100:
+        robot.x, robot.y = rng.uniform(0, (map1.width - 1, map1.height - 1))
+        if map1.distance_to_obstacle((robot.x, robot.y)) < 1:
+            continue
+        robot.sense()
+        bound = robot.clearance_bound()
+        assert np.min(lidar.ranges) >= bound
+        if nearest_method == "visibility":
+            assert robot.pos_cont.closest_obstacle()[1] >= bound
+        n_checked += 1
+
+
+def test_index_control_does_not_trace_beams():
+    map1 = Map("data/two_obs.dat")
+    lidar = LidarSimulator(map1, angles=np.arange(360.))
+    n_traced = []
+    cast_beams = lidar.cast_beams
+    lidar.cast_beams = lambda pos, yaw: n_traced.append(1) or cast_beams(pos, yaw)
+    robot = Robot(map1, lidar=lidar, pos_cont=PositionController(lidar, "index"))
+    for i in range(5):
+        robot.update()
+    assert not n_traced
+    # the reading is traced on demand, at the pose of the last scan
+    sensed_obs, ranges = cast_beams(lidar.pos, lidar.cur_yaw)
+    np.testing.assert_array_equal(lidar.ranges, ranges)
+    np.testing.assert_array_equal(lidar.sensed_obs, sensed_obs)
+    assert len(n_traced) == 1
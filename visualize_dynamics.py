@@ -1,6 +1,7 @@
 from sim_utils import *
 from mpl_toolkits import mplot3d
 import matplotlib.pyplot as plt
+from matplotlib import animation
 
 def visualize_quad_quadhist(ax, quad_hist, t):
     """Works with QuadHist class."""
@@ -83,53 +84,53 @@ def visualize_error(ax_x_error, ax_xd_error, ax_th_error, ax_thr_error, ax_xdd_e
 
     # Position Error
     ax_x_error.plot(np.array(range(len(hist_theta))) *
-                    dt, np.array(hist_pos)[:, 0], 'k')
+                    dt, np.asarray(hist_pos)[:, 0], 'k')
     ax_x_error.plot(np.array(range(len(hist_theta))) *
-                    dt, np.array(hist_pos)[:, 1], 'b')
+                    dt, np.asarray(hist_pos)[:, 1], 'b')
     ax_x_error.plot(np.array(range(len(hist_theta))) *
-                    dt, np.array(hist_pos)[:, 2], 'r')
+                    dt, np.asarray(hist_pos)[:, 2], 'r')
     # Desired Pos
     ax_x_error.plot(np.array(range(len(hist_theta))) *
-                    dt, np.array(hist_des_x)[:, 0], 'k--')
+                    dt, np.asarray(hist_des_x)[:, 0], 'k--')
     ax_x_error.plot(np.array(range(len(hist_theta))) *
-                    dt, np.array(hist_des_x)[:, 1], 'b--')
+                    dt, np.asarray(hist_des_x)[:, 1], 'b--')
     ax_x_error.plot(np.array(range(len(hist_theta))) *
-                    dt, np.array(hist_des_x)[:, 2], 'r--')
+                    dt, np.asarray(hist_des_x)[:, 2], 'r--')
     ax_x_error.set_title("Position (world)")
     ax_x_error.legend(["x", "y", "z"])
 
     # TODO: make into funciton for each plot
     # Velocity Error
     ax_xd_error.plot(np.array(range(len(hist_theta))) *
-                     dt, np.array(hist_xdot)[:, 0], 'k')
+                     dt, np.asarray(hist_xdot)[:, 0], 'k')
     ax_xd_error.plot(np.array(range(len(hist_theta))) *
-                     dt, np.array(hist_xdot)[:, 1], 'b')
+                     dt, np.asarray(hist_xdot)[:, 1], 'b')
     ax_xd_error.plot(np.array(range(len(hist_theta))) *
-                     dt, np.array(hist_xdot)[:, 2], 'r')
+                     dt, np.asarray(hist_xdot)[:, 2], 'r')
     # Desired Velocity
     ax_xd_error.plot(np.array(range(len(hist_theta))) *
-                     dt, np.array(hist_des_xdot)[:, 0], 'k--')
+                     dt, np.asarray(hist_des_xdot)[:, 0], 'k--')
     ax_xd_error.plot(np.array(range(len(hist_theta))) *
-                     dt, np.array(hist_des_xdot)[:, 1], 'b--')
+                     dt, np.asarray(hist_des_xdot)[:, 1], 'b--')
     ax_xd_error.plot(np.array(range(len(hist_theta))) *
-                     dt, np.array(hist_des_xdot)[:, 2], 'r--')
+                     dt, np.asarray(hist_des_xdot)[:, 2], 'r--')
     ax_xd_error.legend(["x", "y", "z"])
     ax_xd_error.set_title("Velocity (world)")
 
     # Angle Error
     ax_th_error.plot(np.array(range(len(hist_theta))) *
-                     dt, np.array(hist_theta)[:, 0], 'k')
+                     dt, np.asarray(hist_theta)[:, 0], 'k')
     ax_th_error.plot(np.array(range(len(hist_theta))) *
-                     dt, np.array(hist_theta)[:, 1], 'b')
+                     dt, np.asarray(hist_theta)[:, 1], 'b')
     ax_th_error.plot(np.array(range(len(hist_theta))) *
-                     dt, np.array(hist_theta)[:, 2], 'r')
+                     dt, np.asarray(hist_theta)[:, 2], 'r')
     # Desired angle
     ax_th_error.plot(np.array(range(len(hist_theta))) *
-                     dt, np.array(hist_des_theta)[:, 0], 'k--')
+                     dt, np.asarray(hist_des_theta)[:, 0], 'k--')
     ax_th_error.plot(np.array(range(len(hist_theta))) *
-                     dt, np.array(hist_des_theta)[:, 1], 'b--')
+                     dt, np.asarray(hist_des_theta)[:, 1], 'b--')
     ax_th_error.plot(np.array(range(len(hist_theta))) *
-                     dt, np.array(hist_des_theta)[:, 2], 'r--')
+                     dt, np.asarray(hist_des_theta)[:, 2], 'r--')
 
     ax_th_error.legend(["Roll", "Pitch", "Yaw"])
     ax_th_error.set_ylim(-40, 40)
@@ -137,11 +138,11 @@ def visualize_error(ax_x_error, ax_xd_error, ax_th_error, ax_thr_error, ax_xdd_e
 
     # Angle Rate
     ax_thr_error.plot(np.array(range(len(hist_theta))) *
-                      dt, np.array(hist_thetadot)[:, 0], 'k')
+                      dt, np.asarray(hist_thetadot)[:, 0], 'k')
     ax_thr_error.plot(np.array(range(len(hist_theta))) *
-                      dt, np.array(hist_thetadot)[:, 1], 'b')
+                      dt, np.asarray(hist_thetadot)[:, 1], 'b')
     ax_thr_error.plot(np.array(range(len(hist_theta))) *
-                      dt, np.array(hist_thetadot)[:, 2], 'r')
+                      dt, np.asarray(hist_thetadot)[:, 2], 'r')
     # ax.plot(range(len(hist_theta)), np.array(des_theta)[:, 0])
     ax_thr_error.legend(["Roll Rate", "Pitch Rate", "Yaw Rate"])
     ax_thr_error.set_ylim(-100, 100)
@@ -151,12 +152,185 @@ def visualize_error(ax_x_error, ax_xd_error, ax_th_error, ax_thr_error, ax_xdd_e
 
     # Acceleration
     ax_xdd_error.plot(np.array(range(len(hist_theta))) *
-                     dt, np.array(hist_xdotdot)[:, 0], 'k')
+                     dt, np.asarray(hist_xdotdot)[:, 0], 'k')
     ax_xdd_error.plot(np.array(range(len(hist_theta))) *
-                      dt, np.array(hist_xdotdot)[:, 1], 'b')
+                      dt, np.asarray(hist_xdotdot)[:, 1], 'b')
     ax_xdd_error.plot(np.array(range(len(hist_theta))) *
-                      dt, np.array(hist_xdotdot)[:, 2], 'r')
+                      dt, np.asarray(hist_xdotdot)[:, 2], 'r')
     ax_xdd_error.legend(["x", "y", "z"])
     ax_xdd_error.set_title("Acc. (world)")
     
     plt.pause(0.1)
+
+
+class QuadDashboard():
+    """Incremental version of visualize_quad_quadhist() and
+    visualize_error_quadhist() for replaying a QuadHistory.
+
+    Artists are created once; each frame only sets their data, and axis
+    limits change only when data leaves them. play() shows the replay
+    interactively, blitting the 3D view and the time series lines over a
+    cached background (redrawn only when limits change). save() writes it
+    to a GIF or video without pauses.
+
+    Parameters
+    ----------
+    quad_hist : QuadHistory
+    dt : float
+        time step between history rows (s)
+    fig : matplotlib Figure or None
+        figure to draw in (cleared), a new one if None
+    """
+
+    COLORS = ('k', 'b', 'r')
+
+    def __init__(self, quad_hist, dt, fig=None):
+        self.quad_hist = quad_hist
+        self.dt = dt
+        self.fig = plt.figure() if fig is None else fig
+        self.fig.clf()
+        fig = self.fig
+
+        # 3D quadrotor: rods, center and trail
+        self.ax = fig.add_subplot(2, 3, 1, projection='3d')
+        self.rod_front, = self.ax.plot3D([], [], [], 'r')  # body x front
+        self.rod_back, = self.ax.plot3D([], [], [], 'k')  # body x back
+        self.rod_y, = self.ax.plot3D([], [], [], 'b')  # body y
+        self.center, = self.ax.plot3D([], [], [], 'o', color='r')
+        self.trail, = self.ax.plot3D([], [], [], '.', color='b', alpha=0.1)
+        self.ax.set_xlabel("x")
+        self.ax.set_ylabel("y")
+        self.ax.set_zlabel("z")
+        self.ax.set_animated(True)  # limits follow the quad, redrawn every frame
+
+        # Time series: (subplot, title, legend, fixed ylim, [(column, dashed)])
+        panels = [(2, "Position (world)", ["x", "y", "z"], None,
+                   [("hist_pos", False), ("hist_des_x", True)]),
+                  (3, "Velocity (world)", ["x", "y", "z"], None,
+                   [("hist_xdot", False), ("hist_des_xdot", True)]),
+                  (4, "Acc. (world)", ["x", "y", "z"], None,
+                   [("hist_xdotdot", False)]),
+                  (5, "Angle", ["Roll", "Pitch", "Yaw"], (-40, 40),
+                   [("hist_theta", False), ("hist_des_theta", True)]),
+                  (6, "Angular Rate", ["Roll Rate", "Pitch Rate", "Yaw Rate"], (-100, 100),
+                   [("hist_thetadot", False)])]
+        self.panels = []
+        for index, title, legend, ylim, columns in panels:
+            ax = fig.add_subplot(2, 3, index)
+            lines = []
+            for column, dashed in columns:
+                for i, color in enumerate(self.COLORS):
+                    line, = ax.plot([], [], color + ('--' if dashed else ''), animated=True)
+                    lines.append((line, column, i))
+            ax.legend([line for line, _, _ in lines[:3]], legend)
+            ax.set_title(title)
+            ax.set_xlim(0, 10 * dt)
+            if ylim is not None:
+                ax.set_ylim(*ylim)
+            self.panels.append((ax, lines, ylim is None))
+        self.y_range = {}  # panel axes -> (min, max) of data shown
+        self.animated = [self.ax] + [line for _, lines, _ in self.panels for line, _, _ in lines]
+
+        self.background = None
+        self.limits_changed = True  # background is stale
+        self.fig.canvas.mpl_connect("draw_event", self._on_draw)
+
+    def _on_draw(self, event):
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self.limits_changed = False
+        self._draw_animated()
+
+    def _draw_animated(self):
+        for artist in self.animated:
+            self.fig.draw_artist(artist)
+
+    def update(self, t):
+        """Show history up to and including step t."""
+        quad_hist = self.quad_hist
+        time_t = np.arange(t + 1) * self.dt
+
+        # 3D quadrotor
+        x = quad_hist.hist_pos[t]
+        R = get_rot_matrix(np.radians(quad_hist.hist_theta[t]))
+        plot_L = 1
+        quad_ends_body = np.array(
+            [[-plot_L, 0, 0], [plot_L, 0, 0], [0, -plot_L, 0], [0, plot_L, 0], [0, 0, 0], [0, 0, 0]]).T
+        ends = np.dot(R, quad_ends_body) + x[:, None]
+        for line, cols in ((self.rod_front, [1, 5]), (self.rod_back, [0, 5]), (self.rod_y, [2, 3])):
+            line.set_data_3d(ends[0, cols], ends[1, cols], ends[2, cols])
+        self.center.set_data_3d(x[0:1], x[1:2], x[2:3])
+        self.trail.set_data_3d(quad_hist.hist_x[:t], quad_hist.hist_y[:t], quad_hist.hist_z[:t])
+        if np.all(np.isfinite(x)):  # keep the last view once a run diverges
+            self.ax.set_xlim(x[0]-3, x[0]+3)
+            self.ax.set_ylim(x[1]-3, x[1]+3)
+            self.ax.set_zlim(x[2]-5, x[2]+5)
+
+        # Time series
+        for ax, lines, autoscale in self.panels:
+            for line, column, i in lines:
+                line.set_data(time_t, getattr(quad_hist, column)[:t+1, i])
+            if time_t[-1] > ax.get_xlim()[1]:
+                ax.set_xlim(0, 2 * time_t[-1])
+                self.limits_changed = True
+            if autoscale:
+                self._grow_ylim(ax, [getattr(quad_hist, column)[t, i] for _, column, i in lines])
+
+    def _grow_ylim(self, ax, values):
+        """Widen ax y limits if values leave them, with half the data range
+        as margin so that limits (and the background) change rarely.
+        NaN and inf values (ex. a diverging run) are ignored."""
+        values = [v for v in values if np.isfinite(v)]
+        if not values:
+            return
+        lo, hi = min(values), max(values)
+        if ax in self.y_range:
+            lo, hi = min(lo, self.y_range[ax][0]), max(hi, self.y_range[ax][1])
+            self.y_range[ax] = (lo, hi)
+            lim_lo, lim_hi = ax.get_ylim()
+            if lo >= lim_lo and hi <= lim_hi:
+                return
+        self.y_range[ax] = (lo, hi)
+        margin = 0.5 * (hi - lo) + 0.5
+        if not (np.isfinite(lo - margin) and np.isfinite(hi + margin)):
+            margin = 0  # values near the float limit
+        ax.set_ylim(lo - margin, hi + margin)
+        self.limits_changed = True
+
+    def draw(self):
+        """Draw the current frame, redrawing the background only if stale."""
+        canvas = self.fig.canvas
+        if self.limits_changed or self.background is None:
+            canvas.draw()  # calls _on_draw()
+        else:
+            canvas.restore_region(self.background)
+            self._draw_animated()
+        canvas.blit(self.fig.bbox)
+        canvas.flush_events()
+
+    def play(self, interval=0.01, frame_skip=1):
+        """Replay the history interactively."""
+        plt.show(block=False)
+        for t in range(0, len(self.quad_hist), frame_skip):
+            self.update(t)
+            self.draw()
+            self.fig.canvas.start_event_loop(interval)
+
+    def save(self, path, fps=10, frame_skip=1, dpi=100):
+        """Write the replay to path offscreen. A .gif is written with Pillow,
+        anything else (ex. .mp4) with ffmpeg."""
+        if path.endswith(".gif"):
+            writer = animation.PillowWriter(fps=fps)
+        else:
+            writer = animation.FFMpegWriter(fps=fps)
+        # writers grab full redraws, which skip animated artists
+        for artist in self.animated:
+            artist.set_animated(False)
+        try:
+            with writer.saving(self.fig, path, dpi):
+                for t in range(0, len(self.quad_hist), frame_skip):
+                    self.update(t)
+                    writer.grab_frame()
+        finally:
+            for artist in self.animated:
+                artist.set_animated(True)
+            self.limits_changed = True